@@ -9,14 +9,23 @@ Includes gradient descent on MSE energy function as a default learning method.
 """
 import numpy as np
 import pickle
-import matplotlib.pyplot as plt
+import itertools
+import copy
+from concurrent.futures import ThreadPoolExecutor
 import StimSet
-from scipy import ndimage
+import profiling
+
+# every assignment to a learner's Q draws a new version from here, so versions
+# are unique across learners and can be used as cache keys by shared StimSets
+_dict_versions = itertools.count()
+
+# ways to draw the initial dictionary, see DictLearner.init_dict
+INIT_METHODS = ('random', 'patches', 'pca', 'kmeans++')
 
 class DictLearner(object):
 
     def __init__(self, data, learnrate, nunits, paramfile=None, theta=0, moving_avg_rate=0.001,
-                 stimshape=None, datatype="image", batch_size=100, pca=None):
+                 stimshape=None, datatype="image", batch_size=100, pca=None, init='random'):
                      
         self.nunits = nunits
         self.batch_size = batch_size
@@ -24,12 +33,38 @@ class DictLearner(object):
         self.paramfile = paramfile
         self.theta=theta       
         self.moving_avg_rate=moving_avg_rate
+        self.corr_every = 1 # trials between updates of corrmatrix_ave; 0 turns them off
+        self.corr_dtype = np.float64 # np.float32 halves the memory and time of the correlation
         self.initialize_stats()
         
         self._load_stims(data, datatype, stimshape, pca)
             
-        self.Q = self.rand_dict()
+        self.Q = self.init_dict(init)
         self.fastmode = False # if true, some stats are not updated to save time
+        self.phase_times = {} # total seconds spent in each phase of run
+        self.infer_iters = 0 # iterations used by the last call to infer
+        self.heldout = None # fixed held-out stimuli for evaluation during run
+        self.updater = None # if set, a dictupdate updater replaces the gradient step in learn
+        self._gram_cache = (None, None)
+        self._buffers = {}
+        # units whose moving-average L0 usage stays below dead_thresh for dead_window
+        # trials are re-seeded during run by reseed_units; None turns this off
+        self.dead_thresh = None
+        self.dead_window = 1000
+        self.reseed_method = 'residual'
+        self._low_usage = np.zeros(nunits, dtype=int)
+        # coarse-to-fine schedule set by start_small; None trains at full size
+        self.growth = None
+        
+    @property
+    def Q(self):
+        """The dictionary, one element per row. Assigning to Q bumps dict_version."""
+        return self._Q
+        
+    @Q.setter
+    def Q(self, value):
+        self._Q = value
+        self.dict_version = next(_dict_versions)
         
     def initialize_stats(self):
         nunits = self.nunits
@@ -42,6 +77,8 @@ class DictLearner(object):
         self.L2acts = np.zeros(nunits)
         self.errorhist = np.array([])
         self.meanacts = np.zeros_like(self.L0acts)
+        # one row per held-out evaluation: trial, SNR, L0 usage, energy
+        self.evalhist = np.zeros((0,4))
         
     def _load_stims(self, data, datatype, stimshape, pca):
         if datatype == "image":
@@ -56,22 +93,41 @@ class DictLearner(object):
         else:
             raise ValueError("Specified data type not currently supported.")
     
-    def infer(self, data, infplot):
+    def infer(self, data, infplot=False, trace=None):
         raise NotImplementedError
         
-    def test_inference(self, niter=None):
+    def test_inference(self, niter=None, quantities=('error', 'energy', 'active'), stride=1, plot=True):
+        """Run inference on a random batch while tracing the given quantities
+        (see profiling.InferenceTrace) and report how many iterations it needed.
+        The trace is kept in self.last_trace."""
         temp = self.niter
         self.niter = niter or self.niter
         X = self.stims.rand_stim()
-        s = self.infer(X, infplot=True)[0]
+        trace = profiling.InferenceTrace(quantities, stride)
+        s = self.infer(X, trace=trace)[0]
         self.niter = temp
         print("Final SNR: " + str(self.snr(X,s)))
+        print("Iterations used: " + str(trace.niter))
+        print("Iterations to get within 1% of final error: " + str(trace.converged_at('error')))
+        print("Iterations to get within 1% of final energy: " + str(trace.converged_at('energy')))
+        if plot:
+            trace.plot()
+        self.last_trace = trace
         return s
         
     def generate_model(self, acts):
         """Reconstruct inputs using linear generative model."""
         return np.dot(self.Q.T,acts)
         
+    def sparsity_cost(self, acts, thresh=None):
+        """Mean over stimuli of the sparsity penalty in this learner's energy function."""
+        return 0.
+        
+    def energy(self, X, acts, thresh=None):
+        """Mean over stimuli of half the squared reconstruction error plus the sparsity cost."""
+        diffs = X - self.generate_model(acts)
+        return 0.5*np.mean(np.sum(diffs**2, axis=0)) + self.sparsity_cost(acts, thresh)
+        
     def compute_errors(self, acts, X):
         """Given a batch of data and activities, compute the squared error between
         the generative model and the original data. Returns vector of mean squared errors."""
@@ -80,12 +136,14 @@ class DictLearner(object):
         
     def smoothed_error(self, window_size=1000, start=0, end=-1):
         """Plots a moving average of the error history with the given averaging window."""
+        import matplotlib.pyplot as plt
         window = np.ones(int(window_size))/float(window_size)
         smoothed = np.convolve(self.errorhist[start:end], window, 'valid')
         plt.plot(smoothed)
         
     def progress_plot(self, window_size=1000, norm=1, start=0, end=-1):
         """Plots a moving average of the error and activity history with the given averaging window."""
+        import matplotlib.pyplot as plt
         window = np.ones(int(window_size))/float(window_size)
         smoothederror = np.convolve(self.errorhist[start:end], window, 'valid')
         if norm==2:
@@ -103,85 +161,462 @@ class DictLearner(object):
         noise = np.var(data - self.Q.T.dot(acts), axis=0)
         return np.mean(sig/noise)
     
-    def learn(self, data, coeffs, normalize = True):
+    def learn(self, data, coeffs, normalize = True, weights=None):
         """Adjust dictionary elements according to gradient descent on the 
         mean-squared error energy function, optionally with an extra term to
         increase orthogonality between basis functions. This term is
         multiplied by the parameter theta.
+        If self.updater is set (see dictupdate.py), it updates the dictionary instead.
+        weights, if given, weigh each stimulus in the gradient and the error, as
+        the importance weights of a StimSet.ImportanceSampler.
         Returns the mean-squared error."""
-        R = data.T - np.dot(coeffs.T, self.Q)
-        self.Q = self.Q + self.learnrate*np.dot(coeffs,R)
+        if self.updater is not None:
+            return self.updater.update(self, data, coeffs, normalize, weights)
+        gradient, mse = self._gradient(data, coeffs, weights)
+        gradient *= self.learnrate
+        self._apply_update(gradient, normalize)
+        return mse
+        
+    def gram(self):
+        """The Gram matrix QQ^T of the dictionary, computed once per dict_version.
+        It is shared, so it is read-only; copy it to modify it."""
+        version, G = self._gram_cache
+        if version != self.dict_version:
+            G = self.Q.dot(self.Q.T)
+            G.flags.writeable = False
+            self._gram_cache = (self.dict_version, G)
+        return G
+        
+    def _buffer(self, name, shape):
+        """A scratch array that is reused while its shape stays the same."""
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != shape:
+            buf = self._buffers[name] = np.empty(shape)
+        return buf
+        
+    def _gradient(self, data, coeffs, weights=None):
+        """Returns (the direction of steepest descent of the squared error with
+        respect to Q, summed over the batch, and the mean-squared error).
+        The gradient is a scratch array that the next call overwrites.
+        With nunits small compared to the batch size and data size, it is
+        cheaper to use coeffs.R = coeffs.X^T - (coeffs.coeffs^T).Q, and the
+        error then follows from the Gram matrix (usually cached by inference).
+        With weights, each stimulus counts weights times in the sum and the mean."""
+        Q = self.Q
+        nunits, datasize = Q.shape
+        nstim = data.shape[1]
+        gradient = self._buffer('gradient', Q.shape)
+        # the weights only need to multiply one side of each product
+        wcoeffs = coeffs if weights is None else coeffs*weights
+        if nunits*(nstim + datasize) < nstim*datasize:
+            np.dot(wcoeffs, data.T, out=gradient)
+            CC = wcoeffs.dot(coeffs.T)
+            # ||X - Q^T C||^2 = ||X||^2 - 2 sum((C X^T) * Q) + sum((C C^T) * (Q Q^T))
+            sqnorms = np.sum(data*data) if weights is None else np.sum(data*data, axis=0).dot(weights)
+            sqerror = sqnorms - 2*np.sum(gradient*Q) + np.sum(CC*self.gram())
+            gradient -= CC.dot(Q)
+            return gradient, max(sqerror, 0.)/data.size
+        R = self._buffer('residual', (nstim, datasize))
+        np.dot(coeffs.T, Q, out=R)
+        np.subtract(data.T, R, out=R)
+        np.dot(wcoeffs, R, out=gradient)
+        if weights is None:
+            return gradient, np.mean(R**2)
+        return gradient, np.einsum('ij,ij->i', R, R).dot(weights)/R.size
+        
+    def _apply_update(self, step, normalize=True):
+        """Add step to Q in place, then apply the orthogonality term and normalize."""
+        Q = self._Q
+        if not Q.flags.writeable:
+            Q = self._Q = Q.copy()
+        Q += step
         if self.theta != 0:
-            # Notice this is calculated using the Q after the mse learning rule
-            thetaterm = (self.Q - np.dot(self.Q,np.dot(self.Q.T,self.Q)))
-            self.Q = self.Q + self.theta*thetaterm
+            # Notice this is calculated using the Q after the mse learning rule.
+            # Q(Q^T Q) costs nunits*datasize^2, (Q Q^T)Q costs nunits^2*datasize
+            if Q.shape[0] < Q.shape[1]:
+                QQQ = np.dot(np.dot(Q, Q.T), Q)
+            else:
+                QQQ = np.dot(Q, np.dot(Q.T, Q))
+            Q *= 1 + self.theta
+            QQQ *= self.theta
+            Q -= QQQ
         if normalize:
             # force dictionary elements to be normalized
-            normmatrix = np.diag(1./np.sqrt(np.sum(self.Q*self.Q,1))) 
-            self.Q = normmatrix.dot(self.Q)
-        return np.mean(R**2)
+            Q /= np.sqrt(np.einsum('ij,ij->i', Q, Q))[:,np.newaxis]
+        # Q changed in place, so caches keyed by its version are stale
+        self.dict_version = next(_dict_versions)
             
-    def run(self, ntrials = 1000, batch_size = None, show=False, rate_decay=None, normalize = True):
+    def run(self, ntrials = 1000, batch_size = None, show=False, rate_decay=None, normalize = True,
+            metrics=None, metrics_every=50, profile=None, heldout=None, eval_every=1000,
+            nworkers=None, sampler=None):
+        """Learn for ntrials batches. The time spent sampling, inferring, learning,
+        storing statistics and saving accumulates in self.phase_times.
+        metrics: a callable, or the name of a .jsonl file, that gets a dict of
+            throughput, per-trial phase times, inference iterations, active
+            fraction and error averaged over every metrics_every trials
+        profile: a profiling.TrialProfiler, or a (start, stop) pair of trial
+            numbers to run cProfile over
+        heldout: stimuli (columns) or a number of stimuli to draw once and keep in
+            self.heldout. Every eval_every trials, SNR, L0 usage and energy on
+            them are computed for a snapshot of Q in a background thread and
+            appended to self.evalhist. An evaluation is skipped if the previous
+            one has not finished, so training never waits for it.
+        nworkers: if more than 1, each batch is split across this many processes
+            that sample and infer against a shared Q (see parallel.py)
+        If self.dead_thresh is set, units that go unused are re-seeded (see reseed_units).
+        After start_small, the dictionary grows on schedule (not with nworkers).
+        sampler: a StimSet.ImportanceSampler to draw the batches (not with
+            nworkers). learn and store_statistics get its importance weights,
+            and it gets the residual norms of each batch."""
         batch_size = batch_size or self.stims.batch_size
-        for trial in range(ntrials):
-            if trial % 50 == 0:
-                print (trial)
-                
-            X = self.stims.rand_stim(batch_size=batch_size)
-            acts,_,_ = self.infer(X)
-            thiserror = self.learn(X, acts, normalize)
-            
-            self.store_statistics(acts, thiserror, batch_size)
-            
-            if (trial % 1000 == 0 or trial+1 == ntrials) and trial != 0:
-                try: 
-                    print ("Saving progress to " + self.paramfile)
-                    self.save()
-                except (ValueError, TypeError) as er:
-                    print ('Failed to save parameters. ', er)
-            if rate_decay is not None:
-                self.adjust_rates(rate_decay)
+        # a writer opened here is closed here; one passed in belongs to the caller
+        own_metrics = isinstance(metrics, str)
+        if own_metrics:
+            metrics = profiling.JSONLWriter(metrics)
+        if profile is not None and not isinstance(profile, profiling.TrialProfiler):
+            profile = profiling.TrialProfiler(*profile)
+        timer = profiling.PhaseTimer(self.phase_times)
+        if heldout is not None:
+            if np.isscalar(heldout):
+                if self.heldout is None or self.heldout.shape[1] != heldout:
+                    self.heldout = self.stims.rand_stim(batch_size=int(heldout))
+            else:
+                self.heldout = heldout
+        runner = None
+        if nworkers is not None and nworkers > 1:
+            if self.growth is not None and self.Q.shape[0] < self.growth['target']:
+                raise ValueError("Data-parallel workers cannot follow a growing dictionary.")
+            if sampler is not None:
+                raise ValueError("Data-parallel workers draw their own batches, so they cannot use a sampler.")
+            import parallel
+            runner = parallel.DataParallelRunner(self, nworkers, batch_size)
+        try:
+            self._run_trials(ntrials, batch_size, rate_decay, normalize, metrics, metrics_every,
+                             profile, heldout, eval_every, timer, runner, sampler)
+        finally:
+            if runner is not None:
+                runner.close()
+            if own_metrics:
+                metrics.close()
         if show:
+            import matplotlib.pyplot as plt
             plt.figure()
             plt.plot(self.errorhist)
-            plt.show()        
+            plt.show()
             
-    def store_statistics(self, acts, thiserror, batch_size=None, center_corr=True):
+    def _run_trials(self, ntrials, batch_size, rate_decay, normalize, metrics, metrics_every,
+                    profile, heldout, eval_every, timer, runner, sampler=None):
+        """The training loop of run. runner, if not None, is a parallel.DataParallelRunner."""
+        iters = 0
+        evaluator = pending = None
+        if heldout is not None:
+            evaluator = ThreadPoolExecutor(max_workers=1)
+        try:
+            for trial in range(ntrials):
+                if trial % 50 == 0:
+                    print (trial)
+                if profile is not None:
+                    profile.step(trial)
+                
+                timer.start()
+                weights = None
+                if runner is None:
+                    if sampler is None:
+                        X = self.stims.rand_stim(batch_size=batch_size)
+                    else:
+                        X, weights = sampler.sample(batch_size)
+                    timer.lap('sample')
+                    acts,_,_ = self.infer(X)
+                else:
+                    # the workers sample and infer their shards together
+                    X, acts = runner.step()
+                iters += self.infer_iters
+                timer.lap('infer')
+                if sampler is not None:
+                    # score the batch against the dictionary it was inferred with, before learn changes it
+                    sampler.update(np.linalg.norm(X - self.generate_model(acts), axis=0))
+                thiserror = self.learn(X, acts, normalize, weights=weights)
+                if runner is not None:
+                    runner.sync()
+                timer.lap('learn')
+            
+                self.store_statistics(acts, thiserror, batch_size, weights=weights)
+                if self.dead_thresh is not None and self._check_dead_units(X) and runner is not None:
+                    runner.sync()
+                if self.growth is not None:
+                    self._grow_step(X)
+                timer.lap('stats')
+            
+                if (trial % 1000 == 0 or trial+1 == ntrials) and trial != 0:
+                    try: 
+                        print ("Saving progress to " + self.paramfile)
+                        self.save()
+                    except (ValueError, TypeError) as er:
+                        print ('Failed to save parameters. ', er)
+                    timer.lap('save')
+                if rate_decay is not None:
+                    self.adjust_rates(rate_decay)
+                
+                if metrics is not None and ((trial+1) % metrics_every == 0 or trial+1 == ntrials):
+                    ndone = trial % metrics_every + 1
+                    metrics(self._window_metrics(trial, ndone, timer, iters))
+                    iters = 0
+                
+                if heldout is not None and (trial+1) % eval_every == 0:
+                    if pending is None or pending.done():
+                        self._record_evaluation(pending)
+                        pending = evaluator.submit(self._evaluate, self._snapshot(), self.heldout, len(self.errorhist))
+                    timer.lap('eval')
+            if evaluator is not None:
+                evaluator.shutdown(wait=True)
+                self._record_evaluation(pending)
+        finally:
+            # also when a trial raises, so the evaluation thread and the profiler are released
+            if evaluator is not None:
+                evaluator.shutdown(wait=True)
+            if profile is not None:
+                profile.close()
+            
+    def _parallel_state(self):
+        """Attributes, besides Q, that change during training and that
+        data-parallel workers need for inference. Sent to them every step."""
+        return {}
+        
+    def _snapshot(self):
+        """A shallow copy of this learner with its own copy of Q, so inference on it
+        is not disturbed by training."""
+        snapshot = copy.copy(self)
+        snapshot.Q = self.Q.copy()
+        return snapshot
+        
+    @staticmethod
+    def _evaluate(snapshot, X, trial):
+        acts = snapshot.infer(X)[0]
+        return (trial, snapshot.snr(X, acts), np.mean(acts != 0), snapshot.energy(X, acts))
+        
+    def _record_evaluation(self, future):
+        if future is not None:
+            self.evalhist = np.vstack((self.evalhist, future.result()))
+        
+    def _window_metrics(self, trial, ntrials, timer, iters):
+        """Summarize the last ntrials trials of run for the metrics stream."""
+        window, wall = timer.flush()
+        metrics = {'trial': trial, 'trials_per_sec': ntrials/wall}
+        for phase in ('sample', 'infer', 'learn', 'stats', 'save'):
+            metrics[phase] = window.get(phase, 0.)/ntrials
+        metrics['infer_iters'] = iters/ntrials
+        metrics['sec_per_iter'] = window.get('infer', 0.)/iters if iters else None
+        metrics['active_fraction'] = float(np.mean(self.L0hist[-ntrials:]))
+        metrics['error'] = float(np.mean(self.errorhist[-ntrials:]))
+        return metrics
+        
+    def store_statistics(self, acts, thiserror, batch_size=None, center_corr=True, weights=None):
+        """Update the moving averages of the per-unit activity moments and the
+        activity correlation matrix, and append this batch to the histories.
+        The correlation is updated every self.corr_every trials (never if 0 or
+        in fastmode), with the averaging rate adjusted to keep its time constant.
+        Only its upper triangle is updated, by a symmetric rank-k update in
+        self.corr_dtype; corrmatrix_ave fills in the rest when read.
+        weights, if given, weigh each stimulus as in learn."""
         batch_size = batch_size or self.batch_size
-        self.L2acts = (1-self.moving_avg_rate)*self.L2acts + self.moving_avg_rate*(acts**2).mean(1)
-        self.L1acts = (1-self.moving_avg_rate)*self.L1acts + self.moving_avg_rate*np.abs(acts).mean(1)
-        L0means = np.mean(acts != 0, axis=1)
-        self.L0acts = (1-self.moving_avg_rate)*self.L0acts + self.moving_avg_rate*L0means
-        means = acts.mean(1)
-        self.meanacts = (1-self.moving_avg_rate)*self.meanacts + self.moving_avg_rate*means
+        nstim = acts.shape[1]
+        rate = self.moving_avg_rate
+        if weights is None:
+            # every per-unit moment, each in one pass over acts
+            sums = acts.sum(1)
+            abssums = np.abs(acts).sum(1)
+            sqsums = np.einsum('ij,ij->i', acts, acts)
+            nonzeros = np.count_nonzero(acts, axis=1)
+        else:
+            sums = acts.dot(weights)
+            abssums = np.abs(acts).dot(weights)
+            sqsums = (acts*acts).dot(weights)
+            nonzeros = (acts != 0).dot(weights)
+            # the correlation is a sum of outer products, each weighted twice
+            acts = acts*np.sqrt(weights)
+        means = sums/nstim
+        self.L2acts = (1-rate)*self.L2acts + rate*sqsums/nstim
+        self.L1acts = (1-rate)*self.L1acts + rate*abssums/nstim
+        self.L0acts = (1-rate)*self.L0acts + rate*nonzeros/nstim
+        self.meanacts = (1-rate)*self.meanacts + rate*means
         self.errorhist = np.append(self.errorhist, thiserror)
-        self.L0hist = np.append(self.L0hist, np.mean(acts!=0))
-        self.L1hist = np.append(self.L1hist, np.mean(np.abs(acts)))
-        self.L2hist = np.append(self.L2hist, np.mean(acts**2))
-        try:
-            if self.fastmode:
-                # skip computing the correlation matrix, which is relatively expensive
-                return
-        except:
-            pass
+        self.L0hist = np.append(self.L0hist, nonzeros.sum()/acts.size)
+        self.L1hist = np.append(self.L1hist, abssums.sum()/acts.size)
+        self.L2hist = np.append(self.L2hist, sqsums.sum()/acts.size)
+        
+        self._corr_count += 1
+        if self.fastmode or not self.corr_every or self._corr_count < self.corr_every:
+            # skip the correlation matrix, which is relatively expensive
+            return
+        self._corr_count = 0
+        rate = 1 - (1-rate)**self.corr_every
         if center_corr:
-            actdevs = acts-means[:,np.newaxis]
-            corrmatrix = (actdevs).dot(actdevs.T)/batch_size
+            scale = 1./batch_size
         else:
-            corrmatrix = acts.dot(acts.T)/self.batch_size
-        self.corrmatrix_ave = (1-self.moving_avg_rate)*self.corrmatrix_ave + self.moving_avg_rate*corrmatrix
-        return corrmatrix
+            scale = 1./self.batch_size
+        self._update_corr(acts, (means if center_corr else None), rate, scale)
+        
+    def _update_corr(self, acts, means, rate, scale):
+        """corr_upper <- (1-rate)*corr_upper + rate*(scale*acts acts^T - means means^T),
+        upper triangle only."""
+        C = self._corr_upper
+        if C.dtype != self.corr_dtype:
+            C = self._corr_upper = np.asfortranarray(C, dtype=self.corr_dtype)
+        try:
+            from scipy.linalg import blas
+        except ImportError:
+            blas = None
+        if blas is None:
+            corrmatrix = scale*acts.dot(acts.T)
+            if means is not None:
+                corrmatrix -= (scale*acts.shape[1])*np.outer(means, means)
+            C *= 1-rate
+            C += (rate*corrmatrix).astype(C.dtype)
+            return
+        single = C.dtype == np.float32
+        syrk, syr = (blas.ssyrk, blas.ssyr) if single else (blas.dsyrk, blas.dsyr)
+        # acts.T is Fortran-ordered, so BLAS reads acts without a copy when the dtypes match
+        A = acts.T.astype(C.dtype, copy=False)
+        # C is kept in Fortran order so that BLAS can overwrite it in place
+        C = syrk(rate*scale, A, beta=1-rate, c=C, trans=1, lower=0, overwrite_c=1)
+        if means is not None:
+            # the outer product of the means is centering; the batch mean is taken over acts.shape[1] stimuli
+            C = syr(-rate*scale*acts.shape[1], means.astype(C.dtype), a=C, lower=0, overwrite_a=1)
+        self._corr_upper = C
+        
+    @property
+    def corrmatrix_ave(self):
+        """Moving average of the activity correlation matrix (symmetric, in corr_dtype)."""
+        C = np.triu(self._corr_upper)
+        C += np.triu(self._corr_upper, 1).T
+        return C
+        
+    @corrmatrix_ave.setter
+    def corrmatrix_ave(self, value):
+        self._corr_upper = np.asfortranarray(value, dtype=self.corr_dtype)
+        self._corr_count = 0
+        
+    def _check_dead_units(self, X):
+        """Count the trials each unit has spent below dead_thresh usage and re-seed
+        those that reach dead_window from the batch X. Returns the number re-seeded."""
+        if len(self.errorhist) < 1/self.moving_avg_rate:
+            # the moving averages are still warming up from zero
+            return 0
+        low = self.L0acts < self.dead_thresh
+        self._low_usage = np.where(low, self._low_usage + 1, 0)
+        dead = np.nonzero(self._low_usage >= self.dead_window)[0]
+        if len(dead) == 0:
+            return 0
+        # learn has changed Q since the batch's coefficients were inferred, so infer them again
+        self.reseed_units(dead, X)
+        print("Re-seeded " + str(len(dead)) + " unused units")
+        return len(dead)
+        
+    def reseed_units(self, units, X=None, acts=None, method=None, noise=0.1):
+        """Give the given units new dictionary elements and reset their statistics
+        and updater state. method (default self.reseed_method) is
+            'residual': the stimuli of the batch X with the largest residuals
+                given acts, normalized (inferred here if acts is None; acts given
+                must come from the current Q)
+            'split': copies of the most used elements plus noise (relative size noise)"""
+        units = np.asarray(units)
+        alive = np.setdiff1d(np.arange(self.Q.shape[0]), units)
+        Q = self.Q.copy()
+        Q[units] = self._new_elements(len(units), alive, X, acts, method, noise)
+        self.Q = Q
+        self._reset_units(units)
+        
+    def _new_elements(self, count, sources, X=None, acts=None, method=None, noise=0.1):
+        """count normalized dictionary elements made by method (see reseed_units),
+        splitting only the units in sources."""
+        method = method or self.reseed_method
+        if method == 'residual':
+            if X is None:
+                X = self.stims.rand_stim(batch_size=max(self.batch_size, count))
+            if acts is None:
+                acts = self.infer(X)[0]
+            R = X - self.generate_model(acts)
+            order = np.argsort(-np.sum(R**2, axis=0))
+            new = R[:, order[np.arange(count) % len(order)]].T
+        elif method == 'split':
+            busiest = sources[np.argsort(-self.L0acts[sources])]
+            new = self.Q[busiest[np.arange(count) % len(busiest)]]
+            new = new + noise*np.random.randn(*new.shape)/np.sqrt(new.shape[1])
+        else:
+            raise ValueError("Unknown reseed method " + str(method))
+        return new/np.linalg.norm(new, axis=1)[:,np.newaxis]
+        
+    def start_small(self, fraction=0.25, every=1000, factor=2., method=None):
+        """Train coarse-to-fine: keep only fraction of the units now (the most used
+        ones), and have run grow the dictionary by factor every `every` trials,
+        with elements made by method (see reseed_units), until it is back to its
+        current size. Inference on the small dictionaries is much cheaper while
+        the elements are still far from converged."""
+        target = self.Q.shape[0]
+        nkeep = max(1, int(round(fraction*target)))
+        keep = np.sort(np.argsort(-self.L0acts, kind='stable')[:nkeep])
+        self.sort(self.L0acts, keep)
+        self.nunits = nkeep
+        self.growth = {'target': target, 'every': every, 'factor': factor, 'method': method}
+        
+    def _grow_step(self, X):
+        """Grow the dictionary from the batch X if the schedule in self.growth says
+        so. Returns the number of units added."""
+        nunits = self.Q.shape[0]
+        if nunits >= self.growth['target'] or len(self.errorhist) % self.growth['every'] != 0:
+            return 0
+        nnew = min(max(1, int(nunits*(self.growth['factor'] - 1))), self.growth['target'] - nunits)
+        # as in _check_dead_units, the coefficients are inferred again on the current Q
+        self.grow_units(nnew, X, method=self.growth['method'])
+        print("Grew dictionary to " + str(self.Q.shape[0]) + " units")
+        return nnew
+        
+    def grow_units(self, nnew, X=None, acts=None, method=None, noise=0.1):
+        """Append nnew dictionary elements made by method (see reseed_units) and
+        extend everything kept per unit to match."""
+        new = self._new_elements(nnew, np.arange(self.Q.shape[0]), X, acts, method, noise)
+        self.Q = np.vstack((self.Q, new))
+        self._grow_units(nnew)
+        
+    def _grow_units(self, nnew):
+        """Extend the statistics and updater state for nnew units appended to Q.
+        Like re-seeded units, they start from the mean of the old units."""
+        for name in ('L0acts', 'L1acts', 'L2acts', 'meanacts'):
+            values = getattr(self, name)
+            setattr(self, name, np.append(values, np.full(nnew, values.mean() if len(values) else 0.)))
+        n = self._corr_upper.shape[0]
+        C = np.zeros((n+nnew, n+nnew), dtype=self._corr_upper.dtype, order='F')
+        C[:n,:n] = self._corr_upper
+        self._corr_upper = C
+        self._low_usage = np.append(self._low_usage, np.zeros(nnew, dtype=int))
+        if self.updater is not None:
+            self.updater.grow(nnew)
+        self.nunits = self.Q.shape[0]
+        
+    def _reset_units(self, units):
+        """Forget the statistics and updater state of the given units. Their moving
+        averages restart from the mean over the other units, so that they are
+        not flagged as dead again right away."""
+        others = np.setdiff1d(np.arange(self.Q.shape[0]), units)
+        for name in ('L0acts', 'L1acts', 'L2acts', 'meanacts'):
+            values = getattr(self, name)
+            values[units] = values[others].mean() if len(others) else 0.
+        self._corr_upper[units,:] = 0
+        self._corr_upper[:,units] = 0
+        self._low_usage[units] = 0
+        if self.updater is not None:
+            self.updater.reset_units(units)
         
-    
     def show_dict(self, stimset=None, cmap='jet', subset=None, square=False, savestr=None):
         """Plot an array of tiled dictionary elements. The 0th element is in the top right."""
+        import matplotlib.pyplot as plt
         stimset = stimset or self.stims
+        # inverse transforms of the whole dictionary are cached by the stimset
+        elems = stimset.for_display(self.Q, version=self.dict_version)
         if subset is not None:
             indices = np.random.choice(self.Q.shape[0], subset)
-            Qs = self.Q[np.sort(indices)]
-        else:
-            Qs = self.Q
-        array = stimset.stimarray(Qs[::-1], square=square)
+            elems = elems[np.sort(indices)]
+        array = stimset._stimarray(elems[::-1], stimset.stimshape, square=square)
         plt.figure()        
         arrayplot = plt.imshow(array,interpolation='nearest', cmap=cmap, aspect='auto', origin='lower')
         plt.axis('off')
@@ -190,8 +625,17 @@ class DictLearner(object):
             plt.savefig(savestr, bbox_inches='tight')
         return arrayplot
         
+    def save_dict_image(self, filename, stimset=None, cmap='jet', square=False):
+        """Write the tiled dictionary, as in show_dict, straight to an image file."""
+        stimset = stimset or self.stims
+        elems = stimset.for_display(self.Q, version=self.dict_version)
+        array = stimset._stimarray(elems[::-1], stimset.stimshape, square=square)
+        stimset.save_array(filename, array, cmap=cmap)
+        
     def show_element(self, index, cmap='jet', labels=None, savestr=None):
-        elem = self.stims.stim_for_display(self.Q[index])
+        import matplotlib.pyplot as plt
+        elem = self.stims.for_display(self.Q, version=self.dict_version)[index]
+        elem = elem.reshape(self.stims.stimshape)
         plt.figure()
         plt.imshow(elem.T, interpolation='nearest',cmap=cmap, aspect='auto', origin='lower')
         if labels is None:
@@ -205,30 +649,57 @@ class DictLearner(object):
         Q = np.random.randn(self.nunits, self.stims.datasize)
         return (np.diag(1/np.sqrt(np.sum(Q**2,1)))).dot(Q)
         
+    def init_dict(self, method='random', nsample=None):
+        """A normalized initial dictionary. method is one of INIT_METHODS:
+            'random': Gaussian noise (rand_dict)
+            'patches': randomly chosen stimuli
+            'pca': the leading principal components of a sample of stimuli, then
+                random stimuli for any units beyond the data dimension
+            'kmeans++': stimuli chosen by k-means++ seeding (see kmeans_seed)
+        The data-driven methods draw nsample stimuli (default 10*nunits, at
+        least 1000) from self.stims."""
+        if method == 'random':
+            return self.rand_dict()
+        if method not in INIT_METHODS:
+            raise ValueError("Unknown init method " + str(method))
+        nsample = nsample or max(10*self.nunits, 1000)
+        X = self.stims.rand_stim(batch_size=nsample).T
+        if method == 'patches':
+            Q = distinct_rows(X, self.nunits)
+        elif method == 'pca':
+            npcs = min(self.nunits, X.shape[1])
+            centered = X - X.mean(0)
+            Q = np.linalg.svd(centered, full_matrices=False)[2][:npcs]
+            Q = np.vstack((Q, distinct_rows(X, self.nunits - npcs)))
+        else:
+            Q = kmeans_seed(X, self.nunits)
+        norms = np.linalg.norm(Q, axis=1)
+        return Q/np.maximum(norms, 1e-12)[:,np.newaxis]
+        
     def adjust_rates(self, factor):
         """Multiply the learning rate by the given factor."""
         self.learnrate = factor*self.learnrate
         self.theta = factor*self.theta
 
     def modulation_plot(self, usepeaks=False, **kwargs):
+        # modspecs[k] is the modulation power spectrum of the kth element
+        import matplotlib.pyplot as plt
+        modspecs = self.stims.modspecs(self.Q, version=self.dict_version)
         modcentroids = np.zeros((self.Q.shape[0],2))
-        for ii in range(self.Q.shape[0]):
-            modspec = self.stims.modspec(self.Q[ii])
-            if usepeaks:
-                modcentroids[ii,0] = np.argmax(np.mean(modspec,axis=1))
-                modcentroids[ii,1] = np.argmax(np.mean(modspec,axis=0))
-            else:
-                modcentroids[ii] = ndimage.measurements.center_of_mass(modspec)
+        if usepeaks:
+            modcentroids[:,0] = np.argmax(modspecs.mean(2), axis=1)
+            modcentroids[:,1] = np.argmax(modspecs.mean(1), axis=1)
+        else:
+            total = modspecs.sum(axis=(1,2))
+            modcentroids[:,0] = modspecs.sum(2).dot(np.arange(modspecs.shape[1]))/total
+            modcentroids[:,1] = modspecs.sum(1).dot(np.arange(modspecs.shape[2]))/total
         plt.scatter(modcentroids[:,0], modcentroids[:,1])
         plt.title('Center of mass of modulation power spectrum of each dictionary element')
-        try:
-            plt.xlabel(kwargs.xlabel)
-        except:
-            pass
-        try:
-            plt.ylabel(kwargs.ylabel)
-        except:
-            pass
+        if 'xlabel' in kwargs:
+            plt.xlabel(kwargs['xlabel'])
+        if 'ylabel' in kwargs:
+            plt.ylabel(kwargs['ylabel'])
+        return modcentroids
         
     def sort_dict(self, batch_size=None, plot = False, allstims = True, savestr=None):
         """Sorts the RFs in order by their usage on a batch. Default batch size
@@ -255,14 +726,36 @@ class DictLearner(object):
         self.sort(usages, sorter, plot, savestr)
         return usages[sorter]
     
+    def compact(self, cutoff, L1=False):
+        """Returns a CompactEncoder that only runs the units whose moving-average
+        usage (L0, or L1 if L1) is at least cutoff. Training state is left alone."""
+        usages = self.L1acts if L1 else self.L0acts
+        keep = np.nonzero(usages >= cutoff)[0]
+        if len(keep) == 0:
+            raise ValueError("No units are used at least " + str(cutoff))
+        small = copy.copy(self)
+        # the copy must not share state that sort or learning would change in place
+        small.updater = None
+        small.paramfile = None
+        small._buffers = {}
+        small.sort(usages, keep)
+        small.nunits = len(keep)
+        return CompactEncoder(small, keep, self.Q.shape[0])
+        
     def sort(self, usages, sorter, plot=False, savestr=None):
+        """Reorder the units, and everything kept per unit, by sorter. sorter
+        can also be a subset of the units, which drops the others."""
         self.Q = self.Q[sorter]
         self.L0acts = self.L0acts[sorter]
         self.L1acts = self.L1acts[sorter]
         self.L2acts = self.L2acts[sorter]
         self.meanacts = self.meanacts[sorter]
-        self.corrmatrix_ave = self.corrmatrix_ave[sorter, sorter]
+        self.corrmatrix_ave = self.corrmatrix_ave[np.ix_(sorter, sorter)]
+        if self.updater is not None:
+            self.updater.permute(sorter)
+        self._low_usage = self._low_usage[sorter]
         if plot:
+            import matplotlib.pyplot as plt
             plt.figure()
             plt.plot(usages[sorter])
             plt.title('L0 Usage')
@@ -276,10 +769,21 @@ class DictLearner(object):
             filename = self.paramfile
         self.paramfile = filename
         with open(filename, 'rb') as f:
-            self.Q, params, histories = pickle.load(f)
+            contents = pickle.load(f)
+        self.Q, params, histories = contents[:3]
+        if len(contents) > 3 and contents[3] is not None:
+            # files saved with an updater also hold its state
+            self.updater = contents[3]
+        if len(contents) > 4:
+            self.growth = contents[4]
+        # a growing dictionary may have been saved at another size
+        self.nunits = self.Q.shape[0]
+        if len(self._low_usage) != self.nunits:
+            self._low_usage = np.zeros(self.nunits, dtype=int)
         (self.errorhist, self.meanacts, self.L0acts, self.L0hist,
                      self.L1acts, self.L1hist, self.L2hist, self.L2acts,
-                     self.corrmatrix_ave) = histories
+                     self.corrmatrix_ave) = histories[:9]
+        self.evalhist = histories[9] if len(histories) > 9 else np.zeros((0,4))
         self.set_params(params)
         
     def set_params(self, params):
@@ -296,7 +800,95 @@ class DictLearner(object):
         params = self.get_param_list()
         histories = (self.errorhist, self.meanacts, self.L0acts, self.L0hist,
                      self.L1acts, self.L1hist, self.L2hist, self.L2acts,
-                     self.corrmatrix_ave)
+                     self.corrmatrix_ave, self.evalhist)
         with open(filename, 'wb') as f:
-            pickle.dump([self.Q, params, histories], f)
+            contents = [self.Q, params, histories]
+            if self.growth is not None:
+                contents += [self.updater, self.growth]
+            elif self.updater is not None:
+                contents.append(self.updater)
+            pickle.dump(contents, f)
                
+
+
+def distinct_rows(X, k):
+    """k different rows of X, chosen at random. rand_stim samples with
+    replacement, and identical dictionary elements get identical coefficients
+    and updates, so they would never separate. If X has fewer than k distinct
+    rows, the repeats get a little noise instead."""
+    distinct = np.unique(X, axis=0)
+    if len(distinct) >= k:
+        return distinct[np.random.choice(len(distinct), k, replace=False)]
+    rows = distinct[np.random.choice(len(distinct), k - len(distinct))]
+    rows = rows + 1e-3*np.std(distinct)*np.random.randn(*rows.shape)
+    return np.vstack((distinct, rows))
+
+
+def kmeans_seed(X, k, per_round=None):
+    """k rows of X chosen by k-means++ seeding under the sign-invariant cosine
+    distance 1 - cos^2 that suits dictionary elements. Each round samples
+    per_round rows (default about k/32) with probability proportional to
+    their distance to the nearest chosen row, then updates all the distances
+    with one matrix product, as in k-means|| (Bahmani et al., 2012)."""
+    # copies of a row could be drawn together in one round
+    X = np.unique(X, axis=0)
+    X = X/np.maximum(np.linalg.norm(X, axis=1), 1e-12)[:,np.newaxis]
+    per_round = per_round or max(1, int(np.ceil(k/32)))
+    chosen = [np.random.randint(len(X))]
+    # rows parallel to a chosen one come out at rounding error rather than 0
+    tiny = 1e-10
+    dist = 1 - X.dot(X[chosen[0]])**2
+    dist[dist < tiny] = 0
+    dist[chosen] = 0
+    while len(chosen) < k:
+        candidates = np.count_nonzero(dist)
+        if candidates == 0:
+            # every row is already covered; fill up at random, with distinct rows while there are any
+            rest = np.setdiff1d(np.arange(len(X)), chosen)
+            need = k - len(chosen)
+            chosen.extend(np.random.choice(rest, need, replace=len(rest) < need) if len(rest) else
+                          np.random.choice(len(X), need))
+            break
+        # without replacement, and chosen rows have distance 0, so no row is picked twice
+        new = np.random.choice(len(X), min(per_round, k - len(chosen), candidates),
+                               replace=False, p=dist/dist.sum())
+        chosen.extend(new)
+        dist = np.minimum(dist, 1 - np.max(X.dot(X[new].T)**2, axis=1))
+        dist[dist < tiny] = 0
+        dist[new] = 0
+    return X[chosen]
+
+
+class CompactEncoder(object):
+    """Inference with a dictionary reduced to a subset of the units of a larger one.
+    learner is a copy of the original learner holding only the units index
+    (original indices); infer and encode scatter the coefficients back to all
+    nunits units, with zeros for the ones that were dropped."""
+
+    def __init__(self, learner, index, nunits):
+        self.learner = learner
+        self.index = index
+        self.nunits = nunits
+
+    @property
+    def Q(self):
+        return self.learner.Q
+
+    def gram(self):
+        return self.learner.gram()
+
+    def expand(self, arr):
+        """Scatter an array with one row per kept unit into one row per original unit."""
+        full = np.zeros((self.nunits,) + arr.shape[1:], dtype=arr.dtype)
+        full[self.index] = arr
+        return full
+
+    def infer(self, X, *args, **kwargs):
+        """As the learner's infer, with every (units x stimuli) result expanded."""
+        results = self.learner.infer(X, *args, **kwargs)
+        return tuple(self.expand(r) if isinstance(r, np.ndarray) and r.ndim == 2
+                     and r.shape[0] == len(self.index) else r for r in results)
+
+    def encode(self, X):
+        """The coefficients for every original unit."""
+        return self.expand(self.learner.infer(X)[0])
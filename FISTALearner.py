@@ -2,7 +2,6 @@
 
 import numpy as np
 from DictLearner import DictLearner
-import scipy.sparse.linalg
 
 """The inference code was adapted from S. Zayd Enam's sparsenet implementation,
 available on github."""
@@ -10,16 +9,32 @@ available on github."""
 class FISTALearner(DictLearner):
     
     def __init__(self, data, learnrate, nunits, lam = 0.4, niter=100, **kwargs):
-        self.lam = 0.4
+        self.lam = lam
         self.niter = niter
+        self._lipschitz_cache = (None, None)
         super().__init__(data, learnrate, nunits, **kwargs)
     
-    def infer(self, data, max_iterations=None, display=False):
+    def sparsity_cost(self, acts, thresh=None):
+        """Half the L1 penalty in the Lasso objective, per stimulus (energy uses half the squared error)."""
+        return 0.5*self.lam*np.mean(np.sum(np.abs(acts), axis=0))
+    
+    def lipschitz(self):
+        """Lipschitz constant of the gradient of the squared error, the largest
+        eigenvalue of 2QQ^T, cached until Q changes."""
+        version, L = self._lipschitz_cache
+        if version != self.dict_version:
+            import scipy.sparse.linalg
+            L = scipy.sparse.linalg.eigsh(2*self.gram(), 1, which='LM')[0][0]
+            self._lipschitz_cache = (self.dict_version, L)
+        return L
+    
+    def infer(self, data, max_iterations=None, display=False, trace=None):
       """ FISTA Inference for Lasso (l1) Problem 
       data: Batches of data (dim x batch)
       Phi: Dictionary (dictionary element x dim) (nparray or sparse array)
       lambdav: Sparsity penalty
       max_iterations: Maximum number of iterations
+      trace: optional profiling.InferenceTrace
       """
       lambdav=self.lam
       def proxOp(x,t):
@@ -27,16 +42,17 @@ class FISTALearner(DictLearner):
         return np.fmax(x-t, 0) + np.fmin(x+t, 0)
     
       x = np.zeros((self.Q.shape[0], data.shape[1]))
-      c = self.Q.dot(self.Q.T)
+      c = self.gram()
       b = -2*self.Q.dot(data)
     
-      L = scipy.sparse.linalg.eigsh(2*c, 1, which='LM')[0]
-      invL = 1/float(L)
+      invL = 1/float(self.lipschitz())
     
       y = x
       t = 1
     
       max_iterations = max_iterations or self.niter
+      if trace is not None:
+        trace.start(max_iterations)
       for i in range(max_iterations):
         g = 2*c.dot(y) + b
         x2 = proxOp(y-invL*g,invL*lambdav)
@@ -46,5 +62,16 @@ class FISTALearner(DictLearner):
         t = t2
         if display == True:
           print ("L1 Objective " +  str(np.sum((data-self.Q.T.dot(x2))**2) + lambdav*np.sum(np.abs(x2))))
+        if trace is not None:
+          trace.record(i, self, data, x2, lambdav)
+    
+      self.infer_iters = max_iterations
+      if trace is not None:
+        trace.finish(max_iterations)
+      return x2, 0, 0
     
-      return x2, 0, 0
\ No newline at end of file
+    def set_params(self, params):
+        self.learnrate, self.lam, self.niter = params
+        
+    def get_param_list(self):
+        return (self.learnrate, self.lam, self.niter)
@@ -7,14 +7,24 @@ Created on Thu Aug 20 15:48:46 2015
 Dictionary learner that uses LCA for inference and gradient descent for learning.
 (Intended for static inputs)
 """
+import contextlib
 import numpy as np
-import matplotlib.pyplot as plt
 from DictLearner import DictLearner
+import profiling
 import pickle
-try:
-    import LCAonGPU
-except ImportError:
-    print("Unable to load GPU implementation. Only CPU inference available.")
+
+
+class FactoredCompetition(object):
+    """The LCA competition matrix QQ^T minus its diagonal, applied to coefficients
+    through Q without forming it: s.c = (s.Q).Q^T - s*diag(QQ^T)."""
+    
+    def __init__(self, Q):
+        self.Q = Q
+        self.norms = np.einsum('ij,ij->i', Q, Q)
+        
+    def rdot(self, s, out):
+        np.dot(np.dot(s, self.Q), self.Q.T, out=out)
+        out -= s*self.norms
 
 
 class LCALearner(DictLearner):
@@ -23,7 +33,9 @@ class LCALearner(DictLearner):
                  batch_size = 100, infrate=.01,
                  niter=300, min_thresh=0.4, adapt=0.95, tolerance = .01, max_iter=4,
                  softthresh = False, datatype = "image", moving_avg_rate=.001,
-                 pca = None, stimshape = None, paramfile = None, gpu=False):
+                 pca = None, stimshape = None, paramfile = None, gpu=False, nthreads=1,
+                 accelerated=False, accel_tol=1e-4, competition='dense', gram_topk=64, gram_thresh=None,
+                 gram_drift=0.05, init='random'):
         """
         An LCALearner is a dictionary learner (DictLearner) that uses a Locally Competitive Algorithm (LCA) for inference.
         By default the LCALearner optimizes for sparsity as measured by the L0 pseudo-norm of the activities of the units
@@ -47,6 +59,24 @@ class LCALearner(DictLearner):
             stimshape: original shape of data (e.g., before unrolling and PCA)
             paramfile: a pickle file with dictionary and error history is stored here     
             gpu: whether or not to use the GPU implementation of
+            nthreads: split the stimuli of each batch among this many threads during CPU inference
+            accelerated: integrate the LCA dynamics with Nesterov momentum and a step size of
+                1/(largest eigenvalue of the Gram matrix) instead of infrate (see _lca_block_accel).
+                With softthresh=True both reach the same L1 minimum: the energy agrees with long
+                plain runs to about 1e-5, while the coefficients are within a few percent (the
+                minimum is flat). With hard thresholding the energy is not convex and the two
+                dynamics settle on different fixed points, so it needs softthresh=True.
+            accel_tol: in accelerated mode, a stimulus stops once its thresholds have reached
+                min_thresh and no internal variable changes by more than this fraction of the largest
+            competition: how CPU inference applies the competition matrix c = QQ^T - I:
+                'dense': store c, nunits^2 per stimulus per iteration
+                'factored': compute (s.Q).Q^T - s without storing c; exact, and cheaper when
+                    nunits > 2*datasize
+                'sparse': approximate c, keeping for each unit its gram_topk largest overlaps
+                    (None for all) and/or those of magnitude at least gram_thresh (see
+                    sparse_competition and sparse_gram_report)
+            gram_drift: relative change in Q after which the sparsity pattern is rebuilt
+            init: how to draw the initial dictionary, one of DictLearner.INIT_METHODS
         """
         
         learnrate = learnrate or 1./batch_size
@@ -59,9 +89,20 @@ class LCALearner(DictLearner):
         self.tolerance = tolerance
         self.max_iter = max_iter
         self.gpu = gpu
+        self.nthreads = nthreads
+        self.accelerated = accelerated
+        self._check_accelerated()
+        self.accel_tol = accel_tol
+        self._lmax_cache = (None, None)
+        self.competition = competition
+        self.gram_topk = gram_topk
+        self.gram_thresh = gram_thresh
+        self.gram_drift = gram_drift
+        self._sparse_cache = None
         self.meanacts = np.zeros(nunits)
         super().__init__(data, learnrate, nunits, paramfile = paramfile, theta=theta, moving_avg_rate=moving_avg_rate, 
-                            stimshape=stimshape, datatype=datatype, batch_size=batch_size, pca=pca)
+                            stimshape=stimshape, datatype=datatype, batch_size=batch_size, pca=pca,
+                            init=init)
         
     def show_oriented_dict(self, batch_size=None, *args, **kwargs):
         """Display tiled dictionary as in DictLearn.show_dict(), but with elements inverted
@@ -76,18 +117,23 @@ class LCALearner(DictLearner):
             means = np.mean(self.infer(X)[0],axis=1)
         toflip = means < 0
         realQ = self.Q
-        self.Q[toflip] = -self.Q[toflip]
+        self.Q = np.where(toflip[:,np.newaxis], -realQ, realQ)
         result = self.show_dict(*args, **kwargs)
         self.Q = realQ
         return result
     
-    def infer_cpu(self, X, infplot=False, tolerance=None, max_iter = None):
+    def infer_cpu(self, X, infplot=False, tolerance=None, max_iter = None, trace=None):
         """Infer sparse approximation to given data X using this LCALearner's 
         current dictionary. Returns coefficients of sparse approximation.
-        Optionally plot reconstruction error vs iteration number.
+        Optionally record quantities per iteration in a profiling.InferenceTrace,
+        or plot reconstruction error vs iteration number (infplot).
         The instance variable niter determines for how many iterations to evaluate
         the dynamical equations. Repeat this many iterations until the mean-squared error
-        is less than the given tolerance or until max_iter repeats."""
+        is less than the given tolerance or until max_iter repeats.
+        If self.nthreads > 1 (and there is no trace), each block of niter iterations
+        runs on shards of the stimuli in a thread pool; the result is the same as
+        with one thread. If self.accelerated, each block stops early once every
+        stimulus has converged."""
         tolerance = tolerance or self.tolerance
         max_iter = max_iter or self.max_iter
         ndict = self.Q.shape[0]
@@ -98,9 +144,7 @@ class LCALearner(DictLearner):
         ci = np.zeros_like(u)
         
         # c is the overlap of dictionary elements with each other, minus identity (i.e., ignore self-overlap)
-        c = self.Q.dot(self.Q.T)
-        for i in range(c.shape[0]):
-            c[i,i] = 0
+        c = self._competition()
         
         # b[i,j] is overlap of stimulus i with dictionary element j
         b = (self.Q.dot(X)).T
@@ -109,58 +153,283 @@ class LCALearner(DictLearner):
         thresh = np.absolute(b).mean(1) 
         thresh = np.array([np.max([th, self.min_thresh]) for th in thresh])
         
-        if infplot:
-            errors = np.zeros(self.niter)
-            allerrors = np.array([])
+        if infplot and trace is None:
+            trace = profiling.InferenceTrace(('error',))
+        if trace is not None:
+            trace.start(self.niter*(max_iter or 1))
+            
+        shards = None
+        pool = limits = contextlib.nullcontext()
+        # traces record the whole batch at every iteration, so tracing runs on one thread
+        if self.nthreads > 1 and nstim > 3 and trace is None:
+            import parallel
+            from concurrent.futures import ThreadPoolExecutor
+            # single-stimulus shards would go through a matrix-vector product, which rounds differently
+            shards = parallel.shard_bounds(nstim, self.nthreads, minsize=2)
+            pool = ThreadPoolExecutor(max_workers=len(shards))
+            limits = parallel.blas_limits(parallel.blas_threads_per_worker(len(shards)))
+        
+        block = self._lca_block
+        extra = ()
+        if self.accelerated:
+            self._check_accelerated()
+            block = self._lca_block_accel
+            # previous u, momentum sequence, step size and whether still moving, per stimulus
+            extra = (np.zeros_like(u), np.ones(nstim), np.full(nstim, 1./self._gram_lmax(c)),
+                     np.ones(nstim, dtype=bool))
         
         error = tolerance+1
         outer_k = 0
-        while(error>tolerance and ((max_iter is None) or outer_k<max_iter)):
-            for kk in range(self.niter):
-                # ci is the competition term in the dynamical equation
-                ci[:] = s.dot(c)
-                u[:] = self.infrate*(b-ci) + (1.-self.infrate)*u
-                if np.max(np.isnan(u)):
-                    raise ValueError("Internal variable blew up at iteration " + str(kk))
-                if self.softthresh:
-                    s[:] = np.sign(u)*np.maximum(0.,np.absolute(u)-thresh[:,np.newaxis]) 
+        iterations = 0
+        with pool, limits:
+            while(error>tolerance and ((max_iter is None) or outer_k<max_iter)):
+                if shards is None:
+                    iterations += block(b, c, u, s, ci, thresh, *extra, X=X, trace=trace, k0=iterations)
                 else:
-                    s[:] = u
-                    s[np.absolute(s) < thresh[:,np.newaxis]] = 0
-                    
-                if infplot:
-                    errors[kk] = np.mean(self.compute_errors(s.T,X))
-                    
-                thresh = self.adapt*thresh
-                thresh[thresh<self.min_thresh] = self.min_thresh
-                
-            error = np.mean((X.T - s.dot(self.Q))**2)
-            outer_k = outer_k+1
-            if infplot:
-                allerrors = np.concatenate((allerrors,errors))
+                    # every stimulus evolves independently, so the shards only meet for the error check
+                    futures = [pool.submit(block, b[start:stop], c, u[start:stop], s[start:stop],
+                                           ci[start:stop], thresh[start:stop], *[arr[start:stop] for arr in extra])
+                               for start, stop in shards]
+                    iterations += max(future.result() for future in futures)
+                error = np.mean((X.T - s.dot(self.Q))**2)
+                outer_k = outer_k+1
+                if self.accelerated and not extra[3].any():
+                    break
+        self.infer_iters = iterations
         
-        if infplot:
-            plt.figure(3)
-            plt.clf()
-            plt.plot(allerrors)
-            return s.T, errors
+        if trace is not None:
+            trace.finish(self.infer_iters)
+            if infplot:
+                trace.plot()
         return s.T, u.T, thresh
 
-    def infer(self, X, infplot=False, tolerance=None, max_iter = None):
+    def _lca_block(self, b, c, u, s, ci, thresh, X=None, trace=None, k0=0):
+        """Run niter iterations of the LCA dynamics, updating u, s and thresh in place.
+        ci is scratch space. The in-place numpy operations release the GIL, so
+        blocks on different stimuli can run in parallel threads. Returns the
+        number of iterations run."""
+        for kk in range(self.niter):
+            # ci is the competition term in the dynamical equation
+            self._compete(s, c, ci)
+            np.subtract(b, ci, out=ci)
+            ci *= self.infrate
+            u *= 1.-self.infrate
+            u += ci
+            if np.isnan(u).any():
+                raise ValueError("Internal variable blew up at iteration " + str(k0+kk))
+            if self.softthresh:
+                s[:] = np.sign(u)*np.maximum(0.,np.absolute(u)-thresh[:,np.newaxis]) 
+            else:
+                np.copyto(s, u)
+                s[np.absolute(s) < thresh[:,np.newaxis]] = 0
+                
+            if trace is not None:
+                trace.record(k0 + kk, self, X, s.T, thresh)
+                
+            thresh *= self.adapt
+            np.maximum(thresh, self.min_thresh, out=thresh)
+        return self.niter
+        
+    def _check_accelerated(self):
+        if self.accelerated and not self.softthresh:
+            raise ValueError("accelerated inference needs softthresh=True; with hard thresholding "
+                             "it settles on a different fixed point than the plain dynamics.")
+        
+    def _competition(self):
+        """The competition matrix c = QQ^T - I in the form self.competition asks
+        for; apply it with _compete."""
+        if self.competition == 'sparse':
+            return self.sparse_competition()
+        if self.competition == 'factored':
+            return FactoredCompetition(self.Q)
+        if self.competition == 'dense':
+            c = self.gram().copy()
+            np.fill_diagonal(c, 0)
+            return c
+        raise ValueError("Unknown competition " + str(self.competition))
+        
+    @staticmethod
+    def _compete(s, c, out):
+        """out = s.c, for a dense c, a FactoredCompetition or a symmetric scipy.sparse c."""
+        if isinstance(c, np.ndarray):
+            np.dot(s, c, out=out)
+        elif isinstance(c, FactoredCompetition):
+            c.rdot(s, out)
+        else:
+            out[:] = c.dot(s.T).T
+            
+    def sparse_competition(self):
+        """The competition matrix (QQ^T without its diagonal) restricted to a sparsity
+        pattern, as a scipy.sparse CSR matrix. For each unit the pattern keeps the
+        gram_topk overlaps of largest magnitude, and/or those of magnitude at least
+        gram_thresh, plus the transposes of those entries so that it stays symmetric.
+        The pattern is found in blocks of rows, so the dense matrix is never stored
+        whole, and rebuilt only once Q has changed by gram_drift (relative norm)
+        since. The values are recomputed from Q whenever it changes."""
+        import scipy.sparse
+        cache = self._sparse_cache
+        Q = self.Q
+        settings = (self.gram_topk, self.gram_thresh)
+        if cache is not None and cache['version'] == self.dict_version and cache['settings'] == settings:
+            return cache['matrix']
+        if (cache is None or cache['Q'].shape != Q.shape or cache['settings'] != settings
+                or np.linalg.norm(Q - cache['Q']) > self.gram_drift*np.linalg.norm(cache['Q'])):
+            cache = self._sparse_cache = self._sparse_pattern()
+        rows, cols = cache['rows'], cache['cols']
+        values = np.empty(len(rows))
+        chunk = 8192
+        for start in range(0, len(rows), chunk):
+            values[start:start+chunk] = np.einsum('ij,ij->i', Q[rows[start:start+chunk]], Q[cols[start:start+chunk]])
+        n = Q.shape[0]
+        matrix = scipy.sparse.csr_matrix((values, (rows, cols)), shape=(n, n))
+        # rebind rather than update in place: snapshots for background evaluation share the old dict
+        self._sparse_cache = dict(cache, matrix=matrix, version=self.dict_version)
+        return matrix
+        
+    def _sparse_pattern(self, blocksize=256):
+        Q = self.Q
+        n = Q.shape[0]
+        masks = []
+        for start in range(0, n, blocksize):
+            overlaps = np.absolute(Q[start:start+blocksize].dot(Q.T))
+            nrows = overlaps.shape[0]
+            overlaps[np.arange(nrows), start + np.arange(nrows)] = 0
+            mask = np.ones_like(overlaps, dtype=bool)
+            if self.gram_topk is not None and self.gram_topk < n-1:
+                mask[:] = False
+                top = np.argpartition(-overlaps, self.gram_topk, axis=1)[:, :self.gram_topk]
+                mask[np.arange(nrows)[:,np.newaxis], top] = True
+            if self.gram_thresh is not None:
+                mask &= overlaps >= self.gram_thresh
+            mask[np.arange(nrows), start + np.arange(nrows)] = False
+            masks.append(np.nonzero(mask))
+        rows = np.concatenate([r + start for r, start in zip([m[0] for m in masks], range(0, n, blocksize))])
+        cols = np.concatenate([m[1] for m in masks])
+        # the union of the pattern and its transpose, without duplicates
+        keys = np.unique(np.concatenate((rows*n + cols, cols*n + rows)))
+        return {'Q': Q.copy(), 'settings': (self.gram_topk, self.gram_thresh), 'version': None,
+                'rows': keys//n, 'cols': keys % n}
+        
+    def sparse_gram_report(self, X=None):
+        """Compare inference with the sparse competition matrix to dense inference
+        on X (by default a random batch). Returns a dict with the fraction of
+        overlaps kept, the relative error of the coefficients, the fraction of
+        stimulus/unit pairs whose active/inactive state differs, the SNR and
+        energy of each, and the time each took."""
+        import time
+        if X is None:
+            X = self.stims.rand_stim()
+        competition = self.competition
+        try:
+            self.competition = 'sparse'
+            t = time.perf_counter()
+            sparse = self.infer(X)[0]
+            sparsetime = time.perf_counter() - t
+            self.competition = 'dense'
+            t = time.perf_counter()
+            dense = self.infer(X)[0]
+            densetime = time.perf_counter() - t
+        finally:
+            self.competition = competition
+        n = self.Q.shape[0]
+        report = {'kept': self.sparse_competition().nnz/(n*(n-1)),
+                  'coeff_error': np.linalg.norm(sparse - dense)/np.linalg.norm(dense),
+                  'support_mismatch': np.mean((sparse != 0) != (dense != 0)),
+                  'snr_dense': self.snr(X, dense), 'snr_sparse': self.snr(X, sparse),
+                  'energy_dense': self.energy(X, dense), 'energy_sparse': self.energy(X, sparse),
+                  'time_dense': densetime, 'time_sparse': sparsetime}
+        for key, value in report.items():
+            print("{:<18}{:.4g}".format(key, value))
+        return report
+        
+    def _threshold(self, u, thresh):
+        if self.softthresh:
+            return np.sign(u)*np.maximum(0.,np.absolute(u)-thresh[:,np.newaxis])
+        return np.where(np.absolute(u) < thresh[:,np.newaxis], 0., u)
+        
+    def _gram_lmax(self, c=None):
+        """Largest eigenvalue of the Gram matrix QQ^T (or of its sparse approximation,
+        if c is the sparse competition matrix), estimated by power iteration and
+        cached until Q changes."""
+        version, lmax = self._lmax_cache
+        if version != (self.dict_version, type(c)):
+            if c is None or isinstance(c, np.ndarray):
+                matvec = self.gram().dot
+            elif isinstance(c, FactoredCompetition):
+                matvec = lambda vec: self.Q.dot(self.Q.T.dot(vec))
+            else:
+                # the diagonal that c leaves out
+                norms = np.einsum('ij,ij->i', self.Q, self.Q)
+                matvec = lambda vec: c.dot(vec) + norms*vec
+            vec = np.ones(self.Q.shape[0])/np.sqrt(self.Q.shape[0])
+            for ii in range(50):
+                vec = matvec(vec)
+                new = np.linalg.norm(vec)
+                vec /= new
+                if ii > 0 and abs(new - lmax) <= 1e-3*new:
+                    break
+                lmax = new
+            # power iteration approaches from below; stay on the safe side
+            lmax = 1.05*new
+            self._lmax_cache = ((self.dict_version, type(c)), lmax)
+        return lmax
+        
+    def _lca_block_accel(self, b, c, u, s, ci, thresh, uprev, tk, eta, moving, X=None, trace=None, k0=0):
+        """Up to niter iterations of LCA with Nesterov momentum on u, updating every
+        argument but b and c in place. Each step extrapolates v = u + beta*(u - uprev)
+        and takes an Euler step of size eta from v. Per stimulus, momentum restarts
+        whenever the step goes against the previous one (adaptive restart), and a
+        step that blows up is undone and eta halved (the stability guard). A stimulus
+        stops moving once its thresholds have reached min_thresh and its largest
+        change is below accel_tol of its largest u. The thresholds anneal as in
+        _lca_block. Returns the number of iterations run."""
+        bound = 1e3*(np.absolute(b).max(1) + 1)
+        for kk in range(self.niter):
+            if not moving.any():
+                return kk
+            tnext = (1 + np.sqrt(1 + 4*tk*tk))/2
+            v = u + ((tk - 1)/tnext)[:,np.newaxis]*(u - uprev)
+            self._compete(self._threshold(v, thresh), c, ci)
+            step = b - v - ci
+            new = v + eta[:,np.newaxis]*step
+            
+            blewup = ~np.isfinite(new).all(1) | (np.absolute(new).max(1) > bound)
+            restart = blewup | (np.sum(step*(new - u), axis=1) < 0)
+            new[blewup] = u[blewup]
+            eta[blewup] *= 0.5
+            new[~moving] = u[~moving]
+            change = np.absolute(new - u).max(1)
+            uprev[:] = np.where(restart[:,np.newaxis], new, u)
+            tk[:] = np.where(restart, 1., tnext)
+            u[:] = new
+            s[:] = self._threshold(u, thresh)
+            
+            if trace is not None:
+                trace.record(k0 + kk, self, X, s.T, thresh)
+                
+            thresh *= self.adapt
+            np.maximum(thresh, self.min_thresh, out=thresh)
+            settled = (thresh <= self.min_thresh) & (change <= self.accel_tol*np.absolute(u).max(1)) & ~blewup
+            moving &= ~settled
+        return self.niter
+
+    def infer(self, X, infplot=False, tolerance=None, max_iter = None, trace=None):
         if self.gpu:
-            # right now there is no support for multiple blocks of iterations, stopping after error crosses threshold, or plots monitoring inference
+            # right now there is no support for multiple blocks of iterations, stopping after error crosses threshold, or inference traces
+            # the GPU backend (and numbapro) is only imported once it is selected
+            import LCAonGPU
+            self.infer_iters = self.niter
             return LCAonGPU.infer(self, X.T)
         else:
-            return self.infer_cpu(X, infplot, tolerance, max_iter)
+            return self.infer_cpu(X, infplot, tolerance, max_iter, trace)
             
-    def test_inference(self, niter=None):
-        temp = self.niter
-        self.niter = niter or self.niter
-        X = self.stims.rand_stim()
-        s = self.infer(X, infplot=True)[0]
-        self.niter = temp
-        print("Final SNR: " + str(self.snr(X,s)))
-        return s
+    def sparsity_cost(self, acts, thresh=None):
+        """Mean over stimuli of the LCA sparsity penalty for the given thresholds
+        (one per stimulus): thresh*|a| for soft thresholding, thresh**2/2 per active unit for hard."""
+        thresh = self.min_thresh if thresh is None else thresh
+        if self.softthresh:
+            return np.mean(np.sum(thresh*np.abs(acts), axis=0))
+        return np.mean(np.sum(0.5*thresh**2*(acts != 0), axis=0))
         
     def adjust_rates(self, factor):
         """Multiply the learning rate by the given factor."""
@@ -6,10 +6,16 @@ Created on Sat May 14 20:00:46 2016
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
 import LCALearner
+import profiling
 import pickle
 
+def _check_single_block(learner):
+    """The infer_cpu methods here run the plain dynamics on one thread, so they
+    cannot honor LCALearner's nthreads or accelerated options."""
+    if learner.nthreads > 1 or learner.accelerated:
+        raise ValueError(type(learner).__name__ + " inference does not support nthreads > 1 or accelerated.")
+
 class HomeostaticLCA(LCALearner.LCALearner):
     """LCA with homeostatic activities, a la SAILnet. Each unit has its own 
     threshold (lambda) which is learned (homeorate) to keep the average activity
@@ -21,19 +27,59 @@ class HomeostaticLCA(LCALearner.LCALearner):
         self.lams = np.ones(args[1])*min_thresh
         super().__init__(*args, **kwargs)
     
-    def learn(self, data, coeffs, normalize = True):
+    def learn(self, data, coeffs, normalize = True, weights=None):
         abscoeffs = np.abs(coeffs)
-        meanabs = np.mean(abscoeffs,1)
+        if weights is None:
+            meanabs = np.mean(abscoeffs,1)
+        else:
+            meanabs = abscoeffs.dot(weights)/len(weights)
         self.lams = self.lams + self.homeorate*(meanabs - self.firingrate)
-        return super().learn(data, coeffs, normalize)
+        return super().learn(data, coeffs, normalize, weights)
+        
+    def _parallel_state(self):
+        return {'lams': self.lams}
+        
+    def sort(self, usages, sorter, plot=False, savestr=None):
+        self.lams = self.lams[sorter]
+        super().sort(usages, sorter, plot, savestr)
+        
+    def _reset_units(self, units):
+        others = np.setdiff1d(np.arange(len(self.lams)), units)
+        self.lams[units] = self.lams[others].mean() if len(others) else self.min_thresh
+        super()._reset_units(units)
+        
+    def _grow_units(self, nnew):
+        self.lams = np.append(self.lams, np.full(nnew, self.lams.mean()))
+        super()._grow_units(nnew)
+        
+    def get_param_list(self):
+        return super().get_param_list() + (self.lams,)
+        
+    def set_params(self, params):
+        super().set_params(params[:8])
+        if len(params) > 8:
+            self.lams = params[8]
+        elif len(self.lams) != self.Q.shape[0]:
+            # older files did not keep the thresholds
+            self.lams = np.full(self.Q.shape[0], self.lams.mean())
+        
+    def sparsity_cost(self, acts, thresh=None):
+        """As LCALearner.sparsity_cost, but with one threshold per unit (self.lams)."""
+        thresh = self.lams[:,np.newaxis]
+        if self.softthresh:
+            return np.mean(np.sum(thresh*np.abs(acts), axis=0))
+        return np.mean(np.sum(0.5*thresh**2*(acts != 0), axis=0))
     
-    def infer_cpu(self, X, infplot=False, tolerance=None, max_iter = None):
+    def infer_cpu(self, X, infplot=False, tolerance=None, max_iter = None, trace=None):
         """Infer sparse approximation to given data X using this LCALearner's 
         current dictionary. Returns coefficients of sparse approximation.
-        Optionally plot reconstruction error vs iteration number.
+        Optionally record quantities per iteration in a profiling.InferenceTrace,
+        or plot reconstruction error vs iteration number (infplot).
         The instance variable niter determines for how many iterations to evaluate
         the dynamical equations. Repeat this many iterations until the mean-squared error
-        is less than the given tolerance or until max_iter repeats."""
+        is less than the given tolerance or until max_iter repeats.
+        Every competition mode works; nthreads and accelerated do not."""
+        _check_single_block(self)
         tolerance = tolerance or self.tolerance
         max_iter = max_iter or self.max_iter
         ndict = self.Q.shape[0]
@@ -45,23 +91,22 @@ class HomeostaticLCA(LCALearner.LCALearner):
         ci = np.zeros_like(u)
         
         # c is the overlap of dictionary elements with each other, minus identity (i.e., ignore self-overlap)
-        c = self.Q.dot(self.Q.T)
-        for i in range(c.shape[0]):
-            c[i,i] = 0
+        c = self._competition()
         
         # b[i,j] is overlap of stimulus i with dictionary element j
         b = (self.Q.dot(X)).T
         
-        if infplot:
-            errors = np.zeros(self.niter)
-            allerrors = np.array([])
+        if infplot and trace is None:
+            trace = profiling.InferenceTrace(('error',))
+        if trace is not None:
+            trace.start(self.niter*(max_iter or 1))
         
         error = tolerance+1
         outer_k = 0
         while(error>tolerance and ((max_iter is None) or outer_k<max_iter)):
             for kk in range(self.niter):
                 # ci is the competition term in the dynamical equation
-                ci[:] = s.dot(c)
+                self._compete(s, c, ci)
                 u[:] = self.infrate*(b-ci) + (1.-self.infrate)*u
                 if np.max(np.isnan(u)):
                     raise ValueError("Internal variable blew up at iteration " + str(kk))
@@ -71,20 +116,18 @@ class HomeostaticLCA(LCALearner.LCALearner):
                     s[:] = u
                     s[np.absolute(s) < thresh] = 0
                     
-                if infplot:
-                    errors[kk] = np.mean(self.compute_errors(s.T,X))
+                if trace is not None:
+                    trace.record(outer_k*self.niter + kk, self, X, s.T, thresh)
                 
                 
             error = np.mean((X.T - s.dot(self.Q))**2)
             outer_k = outer_k+1
-            if infplot:
-                allerrors = np.concatenate((allerrors,errors))
+        self.infer_iters = outer_k*self.niter
         
-        if infplot:
-            plt.figure(3)
-            plt.clf()
-            plt.plot(allerrors)
-            return s.T, errors
+        if trace is not None:
+            trace.finish(self.infer_iters)
+            if infplot:
+                trace.plot()
         return s.T, u.T, thresh
         
     def load_params(self, filename=None):
@@ -109,13 +152,16 @@ class HomeostaticLCA(LCALearner.LCALearner):
         
 class HomeoPositiveLCA(HomeostaticLCA):
     """HomeostaticLCA with activities forced to be positive."""
-    def infer_cpu(self, X, infplot=False, tolerance=None, max_iter = None):
+    def infer_cpu(self, X, infplot=False, tolerance=None, max_iter = None, trace=None):
         """Infer sparse approximation to given data X using this LCALearner's 
         current dictionary. Returns coefficients of sparse approximation.
-        Optionally plot reconstruction error vs iteration number.
+        Optionally record quantities per iteration in a profiling.InferenceTrace,
+        or plot reconstruction error vs iteration number (infplot).
         The instance variable niter determines for how many iterations to evaluate
         the dynamical equations. Repeat this many iterations until the mean-squared error
-        is less than the given tolerance or until max_iter repeats."""
+        is less than the given tolerance or until max_iter repeats.
+        Every competition mode works; nthreads and accelerated do not."""
+        _check_single_block(self)
         tolerance = tolerance or self.tolerance
         max_iter = max_iter or self.max_iter
         ndict = self.Q.shape[0]
@@ -127,23 +173,22 @@ class HomeoPositiveLCA(HomeostaticLCA):
         ci = np.zeros_like(u)
         
         # c is the overlap of dictionary elements with each other, minus identity (i.e., ignore self-overlap)
-        c = self.Q.dot(self.Q.T)
-        for i in range(c.shape[0]):
-            c[i,i] = 0
+        c = self._competition()
         
         # b[i,j] is overlap of stimulus i with dictionary element j
         b = (self.Q.dot(X)).T
         
-        if infplot:
-            errors = np.zeros(self.niter)
-            allerrors = np.array([])
+        if infplot and trace is None:
+            trace = profiling.InferenceTrace(('error',))
+        if trace is not None:
+            trace.start(self.niter*(max_iter or 1))
         
         error = tolerance+1
         outer_k = 0
         while(error>tolerance and ((max_iter is None) or outer_k<max_iter)):
             for kk in range(self.niter):
                 # ci is the competition term in the dynamical equation
-                ci[:] = s.dot(c)
+                self._compete(s, c, ci)
                 u[:] = self.infrate*(b-ci) + (1.-self.infrate)*u
                 if np.max(np.isnan(u)):
                     raise ValueError("Internal variable blew up at iteration " + str(kk))
@@ -153,31 +198,32 @@ class HomeoPositiveLCA(HomeostaticLCA):
                     s[:] = u
                     s[s < thresh] = 0
                     
-                if infplot:
-                    errors[kk] = np.mean(self.compute_errors(s.T,X))
+                if trace is not None:
+                    trace.record(outer_k*self.niter + kk, self, X, s.T, thresh)
                 
                 
             error = np.mean((X.T - s.dot(self.Q))**2)
             outer_k = outer_k+1
-            if infplot:
-                allerrors = np.concatenate((allerrors,errors))
+        self.infer_iters = outer_k*self.niter
         
-        if infplot:
-            plt.figure(3)
-            plt.clf()
-            plt.plot(allerrors)
-            return s.T, errors
+        if trace is not None:
+            trace.finish(self.infer_iters)
+            if infplot:
+                trace.plot()
         return s.T, u.T, thresh
         
 class PositiveLCA(LCALearner.LCALearner):
     """LCA with activities forced to be positive."""
-    def infer_cpu(self, X, infplot=False, tolerance=None, max_iter = None):
+    def infer_cpu(self, X, infplot=False, tolerance=None, max_iter = None, trace=None):
         """Infer sparse approximation to given data X using this LCALearner's 
         current dictionary. Returns coefficients of sparse approximation.
-        Optionally plot reconstruction error vs iteration number.
+        Optionally record quantities per iteration in a profiling.InferenceTrace,
+        or plot reconstruction error vs iteration number (infplot).
         The instance variable niter determines for how many iterations to evaluate
         the dynamical equations. Repeat this many iterations until the mean-squared error
-        is less than the given tolerance or until max_iter repeats."""
+        is less than the given tolerance or until max_iter repeats.
+        Every competition mode works; nthreads and accelerated do not."""
+        _check_single_block(self)
         tolerance = tolerance or self.tolerance
         max_iter = max_iter or self.max_iter
         ndict = self.Q.shape[0]
@@ -188,9 +234,7 @@ class PositiveLCA(LCALearner.LCALearner):
         ci = np.zeros_like(u)
         
         # c is the overlap of dictionary elements with each other, minus identity (i.e., ignore self-overlap)
-        c = self.Q.dot(self.Q.T)
-        for i in range(c.shape[0]):
-            c[i,i] = 0
+        c = self._competition()
         
         # b[i,j] is overlap of stimulus i with dictionary element j
         b = (self.Q.dot(X)).T
@@ -199,16 +243,17 @@ class PositiveLCA(LCALearner.LCALearner):
         thresh = np.absolute(b).mean(1) 
         thresh = np.array([np.max([th, self.min_thresh]) for th in thresh])
         
-        if infplot:
-            errors = np.zeros(self.niter)
-            allerrors = np.array([])
+        if infplot and trace is None:
+            trace = profiling.InferenceTrace(('error',))
+        if trace is not None:
+            trace.start(self.niter*(max_iter or 1))
         
         error = tolerance+1
         outer_k = 0
         while(error>tolerance and ((max_iter is None) or outer_k<max_iter)):
             for kk in range(self.niter):
                 # ci is the competition term in the dynamical equation
-                ci[:] = s.dot(c)
+                self._compete(s, c, ci)
                 u[:] = self.infrate*(b-ci) + (1.-self.infrate)*u
                 if np.max(np.isnan(u)):
                     raise ValueError("Internal variable blew up at iteration " + str(kk))
@@ -218,20 +263,18 @@ class PositiveLCA(LCALearner.LCALearner):
                     s[:] = u
                     s[s < thresh[:,np.newaxis]] = 0
                     
-                if infplot:
-                    errors[kk] = np.mean(self.compute_errors(s.T,X))
+                if trace is not None:
+                    trace.record(outer_k*self.niter + kk, self, X, s.T, thresh)
                     
                 thresh = self.adapt*thresh
                 thresh[thresh<self.min_thresh] = self.min_thresh
                 
             error = np.mean((X.T - s.dot(self.Q))**2)
             outer_k = outer_k+1
-            if infplot:
-                allerrors = np.concatenate((allerrors,errors))
+        self.infer_iters = outer_k*self.niter
         
-        if infplot:
-            plt.figure(3)
-            plt.clf()
-            plt.plot(allerrors)
-            return s.T, errors
+        if trace is not None:
+            trace.finish(self.infer_iters)
+            if infplot:
+                trace.plot()
         return s.T, u.T, thresh
\ No newline at end of file
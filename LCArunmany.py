@@ -5,12 +5,8 @@ Created on Fri Dec 11 22:33:12 2015
 @author: Eric
 """
 
-import scipy.io as io
 import LCALearner
-import numpy as np
-import sys
-import pca.pca
-sys.modules['pca'] = pca.pca
+import spectrodata
 
 import matplotlib.pyplot as plt
 plt.ioff()
@@ -19,15 +15,8 @@ overcompleteness = 0.5
 numinput = 200
 numunits = int(overcompleteness*numinput)
 
-stuff = io.loadmat('../audition/Nicole Code/PCAmatrices4.mat')
-mypca = pca.pca.PCA(dim=200,whiten=True)
-mypca.eVectors = stuff['E'].reshape((25,256,200))[:,::-1,:].reshape((6400,200)).T # flip the PC spectrograms upside down
-mypca.sValues = np.sqrt(np.diag(np.abs(stuff['D1'])))
-mypca.sValues = mypca.sValues[::-1]
-mypca.mean_vec = np.zeros(6400)
-mypca.ready=True
-origshape = (25,256)
-spectros = io.loadmat('../audition/Nicole Code/dMatPCA4.mat')['dMatPCA'].T
+# built from PCAmatrices4.mat and dMatPCA4.mat on first use, with the PC spectrograms flipped upside down
+spectros, mypca, origshape = spectrodata.load_or_build('../audition/Nicole Code/', '4')
 
 lca = LCALearner.LCALearner(spectros, numunits, datatype="spectro", pca = mypca,  stimshape=origshape, paramfile='dummy')
 
@@ -55,8 +44,6 @@ for lam in lambdas:
     plt.figure()
     lca.sort_dict(80000, plot=True)
     plt.savefig(lamstring+'usage.png')
-    plt.figure()
-    lca.show_dict(cmap='jet')
-    plt.savefig(lamstring+'.png')
+    lca.save_dict_image(lamstring+'.png', cmap='jet')
     lca.save_params()
     
\ No newline at end of file
@@ -8,6 +8,8 @@ import argparse
 import pickle
 import LCALearner
 import LCAmods
+import dictupdate
+import DictLearner
 import numpy as np
 import scipy.io as io
 
@@ -21,6 +23,11 @@ parser.add_argument('-i', '--niter', default=200, type=int)
 parser.add_argument('-l', '--lam', default=0.6, type=float)
 parser.add_argument('--load', action='store_true')
 parser.add_argument('--pos', default = False, type=bool)
+parser.add_argument('-u', '--updater', default=None, type=str, choices=sorted(dictupdate.UPDATERS))
+parser.add_argument('--grow', default=None, type=float,
+                    help='start from this fraction of the units and double every --grow_every trials')
+parser.add_argument('--grow_every', default=5000, type=int)
+parser.add_argument('--init', default='random', type=str, choices=DictLearner.INIT_METHODS)
 args=parser.parse_args()
 
 #datafile = args.datafile
@@ -45,7 +52,7 @@ if data == 'images':
     data = io.loadmat(datafile)["IMAGES"]
     if resultsfolder == '':
         resultsfolder = '../vision/Results/'
-    lca = Learner(data, numunits, paramfile='dummy')
+    lca = Learner(data, numunits, paramfile='dummy', init=args.init)
 elif data == 'spectros':
     datafile = '../audition/Data/speech_ptwisecut'
     numinput = 200
@@ -56,7 +63,7 @@ elif data == 'spectros':
     data = data/data.std()
     if resultsfolder == '':
         resultsfolder = '../audition/Results/'       
-    lca = Learner(data, numunits, datatype="spectro", pca = mypca,  stimshape=origshape, paramfile='dummy')
+    lca = Learner(data, numunits, datatype="spectro", pca = mypca,  stimshape=origshape, paramfile='dummy', init=args.init)
 
 
 lca.min_thresh = lam
@@ -69,6 +76,15 @@ savestr = resultsfolder+str(oc)+'OC' + str(lam) + savesuffix
 if load:
     lca.load(savestr + '.pickle')
 lca.save(savestr+'.pickle')
+if args.updater is not None or not load:
+    # a resumed run keeps the updater state saved with it unless told otherwise
+    lca.updater = dictupdate.make_updater(args.updater)
+if args.grow is not None and not load:
+    lca.start_small(args.grow, every=args.grow_every)
 lca.run(ntrials=50000)
-lca.run(ntrials=200000, rate_decay=.99995)
+if isinstance(lca.updater, (dictupdate.OnlineUpdater, dictupdate.AtomAdaGradUpdater)):
+    # these set their own step sizes, so there is no learning rate to decay
+    lca.run(ntrials=200000)
+else:
+    lca.run(ntrials=200000, rate_decay=.99995)
 lca.save()
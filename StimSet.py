@@ -5,7 +5,6 @@ Created on Thu Aug 20 18:23:08 2015
 @author: Eric Dodds
 """
 import numpy as np
-import matplotlib.pyplot as plt
 
 class StimSet(object):
     def __init__(self, data, stimshape, batch_size=None):
@@ -30,6 +29,18 @@ class StimSet(object):
                 vec = vec.reshape(self.stimsize)
             X[:,i] = vec
         return X  
+        
+    def nitems(self, region=None):
+        """Number of items an ImportanceSampler scores separately: the stimuli."""
+        return self.nstims
+        
+    def item_sizes(self, region=None):
+        """How many stimuli each item (see nitems) stands for: one each."""
+        return np.ones(self.nstims)
+        
+    def stims_at(self, items, region=None):
+        """The stimuli with the given indices, one per column."""
+        return self.data[items].reshape((len(items), -1)).T
     
     @staticmethod
     def _stimarray(stims, stimshape, square=False):
@@ -53,37 +64,54 @@ class StimSet(object):
             n = int(np.sqrt(nstim*np.sqrt(height/length)))
             m = int(np.ceil(nstim/n))
         
-        array = 0.5*np.ones((buf+n*(length+buf), buf+m*(height+buf)))
-        k = 0
-        
-        for i in range(m):
-            for j in range(n):
-                if k < nstim:
-                    normfactor = np.max(np.abs(stims[k,:]))
-                    hstart = buf+i*(height+buf)
-                    lstart = buf+j*(length+buf)
-                    thestim = stims[k,:].reshape(length,height)/normfactor
-                    array[lstart:lstart+length, hstart:hstart+height] = thestim
-                    
-                k = k+1
-                
+        # all-zero stimuli (e.g. dead or zero-padded elements) stay 0 instead of 0/0
+        normfactors = np.maximum(np.maximum(stims.max(1), -stims.min(1)), 1e-12)
+        stims = stims.reshape(nstim, length, height)
+        
+        # blocks[j,x,i,y] is pixel (x,y) of the kth stimulus (k = i*n + j);
+        # reshaping the view only splits axes, so it writes straight into array
+        array = np.full((buf+n*(length+buf), buf+m*(height+buf)), 0.5)
+        blocks = array[buf:, buf:].reshape(n, length+buf, m, height+buf)
+        # normalize and place the full columns of stimuli in one pass, then the last partial column
+        nfull = nstim//n
+        last = nfull*n
+        np.divide(stims[:last].reshape(nfull, n, length, height).transpose(1,2,0,3),
+                  normfactors[:last].reshape(nfull, n).T[:,np.newaxis,:,np.newaxis],
+                  out=blocks[:, :length, :nfull, :height])
+        if last < nstim:
+            blocks[:nstim-last, :length, nfull, :height] = stims[last:]/normfactors[last:,np.newaxis,np.newaxis]
         return array.T
     
     def stimarray(self, stims, stimshape=None, square=False):
         stimshape = stimshape or self.stimshape
         return StimSet._stimarray(stims, stimshape, square)
         
+    @staticmethod
+    def save_array(filename, array, cmap='jet'):
+        """Write a tiled array (e.g., from stimarray) to an image file without
+        going through pyplot. The array is displayed as by imshow with origin='lower'."""
+        import matplotlib.image
+        matplotlib.image.imsave(filename, array, cmap=cmap, origin='lower')
+        
+    def for_display(self, stims, version=None):
+        """Returns the given stimuli (one per row) in the original stimulus space.
+        version identifies stims for caching in subclasses that transform them."""
+        return stims
+        
+    def modspecs(self, elems, version=None):
+        """Compute the modulation power spectra of a batch of elements, one per row."""
+        images = self.for_display(elems, version).reshape((-1,)+tuple(self.stimshape))
+        power = np.abs(np.fft.rfft2(images))**2
+        mid = int(power.shape[1]/2)
+        rows = np.arange(mid)
+        return (power[:,rows] + power[:,-rows])/2
+        
     def modspec(self, elem):
         """Compute the modulation power spectrum."""
-        image = elem.reshape(self.stimshape)
-        fourier =  np.fft.rfft2(image)
-        mid = int(fourier.shape[0]/2)
-        power = np.abs(fourier)**2
-        avgmag = np.array([(power[ii] + power[-ii])/2 for ii in range(mid)])
-        return avgmag
+        return self.modspecs(elem)[0]
         
     def stim_for_display(self, stim):
-        return stim.reshape(self.stimshape)
+        return self.for_display(stim).reshape(self.stimshape)
         
 class ImageSet(StimSet):
     """Currently only compatible with square images (but arbitrary patches)."""
@@ -107,14 +135,53 @@ class ImageSet(StimSet):
         for i in range(batch_size):
                 row = self.buffer + int(np.ceil((imsize-length-2*self.buffer)*np.random.rand()))
                 col = self.buffer + int(np.ceil((imsize-height-2*self.buffer)*np.random.rand()))
-                animage = self.data[row:row+length,
-                                      col:col+height,
-                                      np.random.randint(self.data.shape[-1])]                     
-                animage = animage.reshape(self.stimsize)
-                # normalize image
-                animage = animage - np.mean(animage)
-                animage = animage/np.std(animage)
-                X[:,i] = animage
+                X[:,i] = self._patch(row, col, np.random.randint(self.data.shape[-1]), length, height)
+        return X
+        
+    def _patch(self, row, col, image, length, height):
+        """The unrolled patch at (row, col) of the given image, normalized."""
+        animage = self.data[row:row+length,
+                              col:col+height,
+                              image]
+        animage = animage.reshape(self.stimsize)
+        # normalize image
+        animage = animage - np.mean(animage)
+        animage = animage/np.std(animage)
+        return animage
+        
+    def _region_grid(self, region=None):
+        """(spans, region, blocks): as in rand_stim, patches start 1 to spans[0]
+        pixels past the buffer along rows and 1 to spans[1] along columns, and
+        those offsets are cut into blocks of region pixels (default the patch
+        length), blocks[0] along rows and blocks[1] along columns."""
+        region = region or self.stimshape[0]
+        imsize = self.data.shape[0]
+        spans = [imsize - side - 2*self.buffer for side in self.stimshape]
+        return spans, region, [int(np.ceil(span/region)) for span in spans]
+        
+    def nitems(self, region=None):
+        """Number of items an ImportanceSampler scores separately: square regions
+        of region by region patch positions (default the patch length) in each image."""
+        blocks = self._region_grid(region)[2]
+        return self.data.shape[-1]*blocks[0]*blocks[1]
+        
+    def item_sizes(self, region=None):
+        """Number of patch positions in each region (see nitems). Regions along
+        the far edges are cut short, so they hold fewer."""
+        spans, region, blocks = self._region_grid(region)
+        rows, cols = [np.minimum(region, span - region*np.arange(nblocks)) for span, nblocks in zip(spans, blocks)]
+        return np.tile(np.outer(rows, cols).ravel(), self.data.shape[-1]).astype(float)
+        
+    def stims_at(self, items, region=None):
+        """A patch from a random position in each of the given regions (see nitems)."""
+        (rowspan, colspan), region, blocks = self._region_grid(region)
+        length, height = self.stimshape
+        images, rowblocks, colblocks = np.unravel_index(items, (self.data.shape[-1],) + tuple(blocks))
+        X = np.zeros((length*height, len(items)))
+        for i in range(len(items)):
+            row = self.buffer + 1 + rowblocks[i]*region + np.random.randint(min(region, rowspan - rowblocks[i]*region))
+            col = self.buffer + 1 + colblocks[i]*region + np.random.randint(min(region, colspan - colblocks[i]*region))
+            X[:,i] = self._patch(row, col, images[i], length, height)
         return X
         
 class PCvecSet(StimSet):
@@ -123,36 +190,142 @@ class PCvecSet(StimSet):
     def __init__(self, data, stimshape, pca, batch_size=None):
         self.pca = pca
         self.datasize = data.shape[1]
+        self._display_cache = (None, None)
         super().__init__(data, stimshape, batch_size)
         
     def stimarray(self, stims, square=False):
-        reconst = self.pca.inverse_transform(stims)
+        reconst = self.for_display(stims)
         return super().stimarray(reconst, self.stimshape, square)
         
-    def modspec(self, elem):
-        return super().modspec(self.pca.inverse_transform(elem))
-        
-    def stim_for_display(self, stim):
-        return super().stim_for_display(self.pca.inverse_transform(stim))
+    def for_display(self, stims, version=None):
+        """Inverse transform a batch of PC vectors. If version is given, the
+        result is cached and reused for later calls with the same version."""
+        if version is not None and self._display_cache[0] == version:
+            return self._display_cache[1]
+        reconst = self.pca.inverse_transform(stims)
+        if version is not None:
+            self._display_cache = (version, reconst)
+        return reconst
         
 class WaveformSet(StimSet):
     """1D signals, especially audio, of uniform length."""
     
-    def tiledplot(self, stims):
-        """Tiled plots of the given stumili. Zeroth index is over stimuli.
-        Kind of slow, expect about 10s for 100 plots."""
-        nstim = stims.shape[0]
+    @staticmethod
+    def _grid(nstim):
+        """Returns the numbers of rows and columns of plots for nstim waveforms."""
         plotrows = int(np.sqrt(nstim))
         plotcols = int(np.ceil(nstim/plotrows))
-        f, axes = plt.subplots(plotrows, plotcols, sharex=True, sharey=True)
-        for ii in range(nstim):
-            axes.flatten()[ii].plot(stims[ii])
-        f.subplots_adjust(hspace=0, wspace=0)
-        plt.setp([a.get_xticklabels() for a in f.axes[:-1]], visible=False)
-        plt.setp([a.get_yticklabels() for a in f.axes[:-1]], visible=False)
+        return plotrows, plotcols
+    
+    def tiledplot(self, stims, version=None, ax=None, **kwargs):
+        """Tiled plots of the given stimuli. Zeroth index is over stimuli.
+        The 0th stimulus is in the top left, and all plots share a vertical scale.
+        All the waveforms are drawn as a single LineCollection, so thousands
+        of stimuli take well under a second. Extra kwargs go to the LineCollection."""
+        from matplotlib.collections import LineCollection
+        stims = self.for_display(stims, version)
+        nstim, length = stims.shape
+        plotrows, plotcols = self._grid(nstim)
+        row, col = np.divmod(np.arange(nstim), plotcols)
+        
+        # each waveform gets a cell of width length+gap and height 1, offset from the others
+        gap = max(1, int(0.05*length))
+        # all-zero stimuli are drawn flat instead of as NaN
+        scale = 0.45/max(np.max(np.abs(stims)), 1e-12)
+        segments = np.empty((nstim, length, 2))
+        segments[:,:,0] = (col*(length+gap))[:,np.newaxis] + np.arange(length)
+        segments[:,:,1] = -row[:,np.newaxis] + scale*stims
+        
+        if ax is None:
+            import matplotlib.pyplot as plt
+            ax = plt.figure().gca()
+        kwargs.setdefault('linewidths', 0.5)
+        ax.add_collection(LineCollection(segments, **kwargs))
+        ax.set_xlim(-gap, plotcols*(length+gap))
+        ax.set_ylim(-plotrows+0.5, 0.5)
+        ax.axis('off')
+        return ax
+        
+    def waveform_mosaic(self, stims, version=None, cellheight=32):
+        """Rasterize the given stimuli into an image with the same layout as tiledplot.
+        Pixels on a waveform are 1 and the rest 0 (uint8), with row 0 at the top."""
+        stims = self.for_display(stims, version)
+        nstim, length = stims.shape
+        plotrows, plotcols = self._grid(nstim)
+        buf = 1
+        
+        # pixel row of each sample; each column is filled between a sample and the next
+        peak = max(np.max(np.abs(stims)), 1e-12)
+        ys = np.rint((0.5 - 0.45*stims/peak)*(cellheight-1)).astype(int)
+        nextys = np.concatenate((ys[:,1:], ys[:,-1:]), axis=1)
+        lo = np.minimum(ys, nextys)[:,np.newaxis,:]
+        hi = np.maximum(ys, nextys)[:,np.newaxis,:]
+        pixels = np.arange(cellheight)[np.newaxis,:,np.newaxis]
+        cells = np.zeros((plotrows*plotcols, cellheight, length), dtype=np.uint8)
+        # in chunks of stimuli, so the boolean temporaries stay small
+        for start in range(0, nstim, 256):
+            chunk = slice(start, min(start+256, nstim))
+            cells[chunk] = (pixels >= lo[chunk]) & (pixels <= hi[chunk])
+        
+        mosaic = np.zeros((buf+plotrows*(cellheight+buf), buf+plotcols*(length+buf)), dtype=np.uint8)
+        blocks = mosaic[buf:, buf:].reshape(plotrows, cellheight+buf, plotcols, length+buf)
+        blocks[:, :cellheight, :, :length] = cells.reshape(plotrows, plotcols, cellheight, length).transpose(0,2,1,3)
+        return mosaic
+        
+    def save_mosaic(self, filename, stims, version=None, cellheight=32, cmap='gray_r'):
+        """Write the mosaic from waveform_mosaic straight to an image file."""
+        import matplotlib.image
+        matplotlib.image.imsave(filename, self.waveform_mosaic(stims, version, cellheight), cmap=cmap)
         
 class WaveformPCSet(PCvecSet, WaveformSet):
-    """Specifically for PCA reps of waveforms."""
-    
-    def tiledplot(self, stims):
-        super().tiledplot(self.pca.inverse_transform(stims))
\ No newline at end of file
+    """Specifically for PCA reps of waveforms. The WaveformSet plots
+    inverse-transform the stimuli through PCvecSet.for_display."""
+
+
+class ImportanceSampler(object):
+    """Draws training batches from a StimSet in proportion to a score kept for
+    each item (stimulus, or image region for an ImageSet, see nitems). The
+    score of an item is the residual norm of the last time it was drawn, so it
+    is only refreshed for items that are seen. A fraction mix of the
+    probability is spread uniformly, so every item is still drawn now and then
+    and no importance weight exceeds 1/mix.
+
+    Items may stand for different numbers of stimuli (see StimSet.item_sizes),
+    so uniform sampling means drawing each item in proportion to its size, as
+    rand_stim would. sample returns the batch and its importance weights, the
+    ratio of that probability to the one it was drawn with, which make weighted
+    means over the batch unbiased estimates of means over the data. Pass them
+    to DictLearner.learn, or give the sampler to run."""
+
+    def __init__(self, stims, region=None, mix=0.2):
+        self.stims = stims
+        self.region = region
+        self.mix = mix
+        self.nitems = stims.nitems(region)
+        sizes = stims.item_sizes(region)
+        self.uniform = sizes/sizes.sum()
+        # scores start as the mean of the first batch, which is drawn uniformly
+        self.scores = None
+        self.last = None
+
+    def probabilities(self):
+        if self.scores is None:
+            return self.uniform
+        weighted = self.uniform*self.scores
+        return (1-self.mix)*weighted/weighted.sum() + self.mix*self.uniform
+
+    def sample(self, batch_size):
+        """Returns (X, weights): a batch of batch_size stimuli (columns) and
+        their importance weights."""
+        p = self.probabilities()
+        self.last = np.random.choice(self.nitems, batch_size, p=p)
+        return self.stims.stims_at(self.last, self.region), self.uniform[self.last]/p[self.last]
+
+    def update(self, errors):
+        """Record the residual norms of the last batch drawn as its items' scores."""
+        if self.scores is None:
+            self.scores = np.full(self.nitems, np.mean(errors))
+        self.scores[self.last] = errors
+        if not self.scores.sum() > 0:
+            # nothing left to reconstruct; go back to uniform sampling
+            self.scores = None
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks for the inference and learning engines, on synthetic data.
+
+Each benchmark is timed over a grid of number of units, batch size, data
+dimension and sparsity. For the inference engines, sparsity is the penalty
+(min_thresh, lam or lamb); for learn and store_statistics it is the fraction
+of nonzero coefficients in the synthetic activities. Results are written to a
+json file, and --compare flags cases that got slower than a stored run.
+--scaling measures training throughput of the data-parallel runner (see
+parallel.py) for several numbers of worker processes.
+
+Usage:
+    python benchmarks.py -o bench_results/mine.json
+    python benchmarks.py --quick --compare bench_results/mine.json
+    python benchmarks.py --scaling 1 2 4 -b
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import time
+import numpy as np
+import LCALearner
+import LCAmods
+import FISTALearner
+import sparsenet
+
+GRID = {'nunits': (64, 256, 512),
+        'batch_size': (32, 100),
+        'dim': (64, 256),
+        'sparsity': (0.4, 1.0)}
+QUICK_GRID = {'nunits': (64, 256),
+              'batch_size': (100,),
+              'dim': (64,),
+              'sparsity': (0.4,)}
+NITER = 50
+
+
+def synthetic_images(patchsize, nimages=4, seed=0):
+    """Smooth random images, big enough for ImageSet to cut patchsize patches from."""
+    rng = np.random.RandomState(seed)
+    imsize = 2*20 + 4*patchsize
+    images = rng.randn(imsize, imsize, nimages)
+    # a little spatial correlation so the data are not white
+    images = images + np.roll(images, 1, axis=0) + np.roll(images, 1, axis=1)
+    return images
+
+
+def make_learner(kind, nunits, batch_size, dim, sparsity, seed=0):
+    np.random.seed(seed)
+    patch = int(np.sqrt(dim))
+    images = synthetic_images(patch, seed=seed)
+    common = dict(batch_size=batch_size, stimshape=(patch, patch))
+    if kind == 'FISTALearner':
+        learner = FISTALearner.FISTALearner(images, 0.01, nunits, niter=NITER, **common)
+        learner.lam = sparsity
+    elif kind == 'Sparsenet':
+        learner = sparsenet.Sparsenet(images, nunits, niter=NITER, lamb=sparsity, **common)
+    else:
+        cls = LCALearner.LCALearner if kind == 'LCALearner' else getattr(LCAmods, kind)
+        learner = cls(images, nunits, niter=NITER, max_iter=1, min_thresh=sparsity, **common)
+        if hasattr(learner, 'lams'):
+            learner.lams = sparsity*np.ones(nunits)
+    return learner
+
+
+def synthetic_acts(nunits, batch_size, density, rng):
+    acts = rng.randn(nunits, batch_size)
+    acts[rng.rand(nunits, batch_size) > density] = 0
+    return acts
+
+
+def bench_infer(kind):
+    def setup(nunits, batch_size, dim, sparsity):
+        learner = make_learner(kind, nunits, batch_size, dim, sparsity)
+        X = learner.stims.rand_stim(batch_size=batch_size)
+        return lambda: learner.infer(X)
+    return setup
+
+
+def bench_learn(nunits, batch_size, dim, sparsity):
+    learner = make_learner('LCALearner', nunits, batch_size, dim, 0.4)
+    rng = np.random.RandomState(1)
+    X = learner.stims.rand_stim(batch_size=batch_size)
+    acts = synthetic_acts(nunits, batch_size, sparsity, rng)
+    return lambda: learner.learn(X, acts)
+
+
+def bench_store_statistics(nunits, batch_size, dim, sparsity):
+    learner = make_learner('LCALearner', nunits, batch_size, dim, 0.4)
+    acts = synthetic_acts(nunits, batch_size, sparsity, np.random.RandomState(1))
+    return lambda: learner.store_statistics(acts, 0.1, batch_size)
+
+
+def bench_rand_stim(nunits, batch_size, dim, sparsity):
+    learner = make_learner('LCALearner', 16, batch_size, dim, 0.4)
+    return lambda: learner.stims.rand_stim(batch_size=batch_size)
+
+
+# name: (setup function, axes that matter)
+BENCHMARKS = {
+    'LCALearner.infer_cpu': (bench_infer('LCALearner'), ('nunits', 'batch_size', 'dim', 'sparsity')),
+    'HomeostaticLCA.infer_cpu': (bench_infer('HomeostaticLCA'), ('nunits', 'batch_size', 'dim', 'sparsity')),
+    'PositiveLCA.infer_cpu': (bench_infer('PositiveLCA'), ('nunits', 'batch_size', 'dim', 'sparsity')),
+    'HomeoPositiveLCA.infer_cpu': (bench_infer('HomeoPositiveLCA'), ('nunits', 'batch_size', 'dim', 'sparsity')),
+    'FISTALearner.infer': (bench_infer('FISTALearner'), ('nunits', 'batch_size', 'dim', 'sparsity')),
+    'Sparsenet.infer': (bench_infer('Sparsenet'), ('nunits', 'batch_size', 'dim', 'sparsity')),
+    'DictLearner.learn': (bench_learn, ('nunits', 'batch_size', 'dim', 'sparsity')),
+    'DictLearner.store_statistics': (bench_store_statistics, ('nunits', 'batch_size', 'sparsity')),
+    'ImageSet.rand_stim': (bench_rand_stim, ('batch_size', 'dim')),
+}
+
+
+def data_parallel_throughput(nworkers, nunits=256, batch_size=128, dim=256, ntrials=20):
+    """Stimuli per second through sampling, inference and learn, with the
+    batches split over nworkers processes (in process if nworkers is 1)."""
+    learner = make_learner('LCALearner', nunits, batch_size, dim, 0.4)
+    if nworkers == 1:
+        def step():
+            X = learner.stims.rand_stim(batch_size=batch_size)
+            learner.learn(X, learner.infer(X)[0])
+        close = lambda: None
+    else:
+        import parallel
+        runner = parallel.DataParallelRunner(learner, nworkers, batch_size)
+        def step():
+            learner.learn(*runner.step())
+            runner.sync()
+        close = runner.close
+    try:
+        step()
+        t = time.perf_counter()
+        for trial in range(ntrials):
+            step()
+        return ntrials*batch_size/(time.perf_counter() - t)
+    finally:
+        close()
+        
+        
+def scaling(workers=(1, 2, 4), ntrials=20):
+    results = {}
+    for nworkers in workers:
+        rate = data_parallel_throughput(nworkers, ntrials=ntrials)
+        results[str(nworkers)] = rate
+        print("{:>2} workers {:>10.1f} stimuli/s {:>6.2f}x".format(nworkers, rate, rate/results[str(workers[0])]))
+    return results
+
+
+def timeit(func, repeats=5, mintime=0.2):
+    """Returns (best, median) seconds per call, calling func enough times per
+    repeat to take at least mintime."""
+    func()
+    number = 1
+    while True:
+        t = time.perf_counter()
+        for ii in range(number):
+            func()
+        elapsed = time.perf_counter() - t
+        if elapsed >= mintime or number >= 1000:
+            break
+        number = number*2
+    times = [elapsed/number]
+    for rr in range(repeats-1):
+        t = time.perf_counter()
+        for ii in range(number):
+            func()
+        times.append((time.perf_counter() - t)/number)
+    return min(times), float(np.median(times))
+
+
+def case_key(name, params):
+    return name + '[' + ','.join(key+'='+str(params[key]) for key in sorted(params)) + ']'
+
+
+def run(grid=GRID, names=None, repeats=5, mintime=0.2):
+    results = {}
+    # names=None runs every benchmark, an empty list none
+    for name in sorted(BENCHMARKS) if names is None else names:
+        setup, axes = BENCHMARKS[name]
+        cases = set(tuple((axis, value if axis in axes else grid[axis][0]) for axis, value in zip(sorted(grid), combo))
+                    for combo in itertools.product(*[grid[axis] for axis in sorted(grid)]))
+        for case in sorted(cases):
+            params = dict(case)
+            func = setup(**params)
+            best, median = timeit(func, repeats, mintime)
+            key = case_key(name, {axis: params[axis] for axis in axes})
+            results[key] = {'benchmark': name, 'params': params, 'best': best, 'median': median}
+            print("{:<80} {:>10.3f} ms".format(key, 1000*best))
+    return results
+
+
+def environment():
+    try:
+        rev = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)),
+                                      stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        rev = None
+    return {'git': rev, 'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'node': platform.node(), 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def compare(results, baselinefile, tolerance=1.2):
+    """Print every case that is more than tolerance times slower than in the baseline.
+    Returns the list of regressed case keys."""
+    with open(baselinefile) as f:
+        baseline = json.load(f)['results']
+    regressed = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        ratio = result['best']/baseline[key]['best']
+        if ratio > tolerance:
+            regressed.append(key)
+            print("REGRESSION {:<70} {:>6.2f}x slower".format(key, ratio))
+        elif ratio < 1/tolerance:
+            print("faster     {:<70} {:>6.2f}x faster".format(key, 1/ratio))
+    print(str(len(regressed)) + " regressions against " + baselinefile)
+    return regressed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark inference and learning on synthetic data.")
+    parser.add_argument('-o', '--output', default=None, type=str)
+    parser.add_argument('-b', '--benchmarks', nargs='*', default=None, choices=sorted(BENCHMARKS))
+    parser.add_argument('--quick', action='store_true')
+    parser.add_argument('--compare', default=None, type=str)
+    parser.add_argument('--tolerance', default=1.2, type=float)
+    parser.add_argument('-r', '--repeats', default=5, type=int)
+    parser.add_argument('--scaling', nargs='*', default=None, type=int,
+                        help='numbers of data-parallel workers to measure throughput for')
+    args = parser.parse_args()
+
+    results = run(QUICK_GRID if args.quick else GRID, args.benchmarks, args.repeats)
+    output = {'environment': environment(), 'results': results}
+    if args.scaling is not None:
+        output['environment']['cpus'] = os.cpu_count()
+        output['scaling'] = scaling(args.scaling or (1, 2, 4))
+    if args.output is not None:
+        outdir = os.path.dirname(args.output)
+        if outdir:
+            os.makedirs(outdir, exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=1)
+    if args.compare is not None:
+        regressed = compare(results, args.compare, args.tolerance)
+        if regressed:
+            raise SystemExit(1)
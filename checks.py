@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Equivalence checks for the optimized code paths, on synthetic data.
+
+Each check runs an optimized path and a straightforward reference for the
+same inputs and asserts that they agree. Run them all with
+
+    python checks.py
+"""
+import numpy as np
+import compare_learners
+
+
+def _learner(name='LCALearner', dim=32, nunits=64, batch_size=50, **kwargs):
+    truedict, data = compare_learners.ground_truth(dim, nunits, nstims=2000)
+    learner = compare_learners.make_learners([name], data, nunits, batch_size)[name]
+    for key, value in kwargs.items():
+        setattr(learner, key, value)
+    return learner
+
+
+def _reference_learn(Q, data, coeffs, learnrate, theta):
+    """DictLearner.learn as it was before it updated Q in place: returns (new Q, mse)."""
+    R = data.T - np.dot(coeffs.T, Q)
+    Q = Q + learnrate*np.dot(coeffs, R)
+    if theta != 0:
+        Q = Q + theta*(Q - np.dot(Q, np.dot(Q.T, Q)))
+    Q = np.diag(1./np.sqrt(np.sum(Q*Q, 1))).dot(Q)
+    return Q, np.mean(R**2)
+
+
+def check_inplace_learn():
+    """learn, which updates Q in place and may take the error from the Gram
+    matrix, against the old out-of-place update, for both ways _gradient
+    computes the gradient (few units and a large batch, and the reverse)."""
+    for dim, nunits, batch_size in ((32, 16, 200), (32, 64, 20)):
+        for theta in (0., 0.01):
+            learner = _learner(dim=dim, nunits=nunits, batch_size=batch_size, theta=theta)
+            X = learner.stims.rand_stim(batch_size=batch_size)
+            acts = learner.infer(X)[0]
+            expected, expected_mse = _reference_learn(learner.Q.copy(), X, acts, learner.learnrate, theta)
+            version = learner.dict_version
+            mse = learner.learn(X, acts)
+            assert learner.dict_version != version, "learn did not invalidate the dictionary caches"
+            np.testing.assert_allclose(learner.Q, expected, rtol=0, atol=1e-12)
+            np.testing.assert_allclose(mse, expected_mse, rtol=1e-9)
+            np.testing.assert_allclose(learner.gram(), learner.Q.dot(learner.Q.T), rtol=0, atol=1e-12)
+
+
+def check_sharded_inference():
+    """LCALearner inference split across threads (nthreads > 1) against one
+    thread, for each competition mode, with soft and hard thresholds, plain
+    and (soft only) accelerated, and for several blocks of niter iterations."""
+    learner = _learner(nunits=128, max_iter=2, gram_topk=16)
+    X = learner.stims.rand_stim(batch_size=101)
+    for competition in ('dense', 'factored', 'sparse'):
+        for softthresh in (False, True):
+            for accelerated in (False, True):
+                if accelerated and not softthresh:
+                    # rejected by LCALearner, see _check_accelerated
+                    continue
+                learner.competition, learner.softthresh, learner.accelerated = competition, softthresh, accelerated
+                learner.nthreads = 1
+                expected = learner.infer(X)
+                learner.nthreads = 4
+                result = learner.infer(X)
+                for a, b in zip(result, expected):
+                    np.testing.assert_allclose(a, b, rtol=0, atol=1e-12,
+                                               err_msg=str((competition, softthresh, accelerated)))
+
+
+def check_corr_update():
+    """The correlation moving average in store_statistics, a symmetric rank-k
+    BLAS update of the upper triangle, against the full matrix products, with
+    and without centering and importance weights, in float64 and float32."""
+    rng = np.random.RandomState(0)
+    nunits, nstim = 64, 40
+    acts = rng.randn(nunits, nstim)*(rng.rand(nunits, nstim) < 0.2)
+    start = np.cov(rng.randn(nunits, 3*nunits))
+    for dtype, rtol in ((np.float64, 1e-12), (np.float32, 1e-5)):
+        for center_corr in (False, True):
+            for weights in (None, rng.rand(nstim)*2):
+                learner = _learner(nunits=nunits, batch_size=nstim, corr_dtype=dtype, corr_every=1)
+                learner.corrmatrix_ave = start
+                learner.store_statistics(acts, 0., center_corr=center_corr, weights=weights)
+                w = np.ones(nstim) if weights is None else weights
+                outer = (acts*w).dot(acts.T)
+                if center_corr:
+                    means = acts.dot(w)/nstim
+                    outer -= nstim*np.outer(means, means)
+                rate = learner.moving_avg_rate
+                expected = (1-rate)*start + rate*outer/nstim
+                np.testing.assert_allclose(learner.corrmatrix_ave, expected, rtol=rtol, atol=rtol*np.abs(expected).max(),
+                                           err_msg=str((dtype.__name__, center_corr, weights is not None)))
+
+
+CHECKS = [check_inplace_learn, check_sharded_inference, check_corr_update]
+
+
+if __name__ == '__main__':
+    for check in CHECKS:
+        check()
+        print(check.__name__ + ": ok")
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Time-to-quality comparison of the dictionary learners on synthetic data.
+
+Data are generated from a known dictionary with sparse Gaussian coefficients
+plus noise. Every learner trains on the same data, and at regular checkpoints
+the harness records the wall time spent training, the held-out SNR (from
+DictLearner.snr) and how well the true dictionary has been recovered. The
+curves are written to json (and optionally plotted), and a summary table
+shows how long each learner took to reach the target SNR.
+
+Usage:
+    python compare_learners.py --ntrials 2000 --target 20 -o ttq.json --plot ttq.png
+"""
+import argparse
+import json
+import time
+import numpy as np
+import DictLearner
+import LCALearner
+import LCAmods
+import FISTALearner
+import sparsenet
+import spectrodata
+import dictupdate
+
+
+def ground_truth(dim=64, nunits=128, nstims=20000, nactive=4, noise=0.05, seed=0):
+    """Returns (dictionary, data): a random unit-norm dictionary (units x dim)
+    and nstims samples (one per row) that each use nactive of its elements."""
+    rng = np.random.RandomState(seed)
+    dictionary = rng.randn(nunits, dim)
+    dictionary /= np.linalg.norm(dictionary, axis=1)[:,np.newaxis]
+    coeffs = np.zeros((nstims, nunits))
+    rows = np.repeat(np.arange(nstims), nactive)
+    cols = np.array([rng.choice(nunits, nactive, replace=False) for ii in range(nstims)]).ravel()
+    coeffs[rows, cols] = rng.randn(nstims*nactive)
+    data = coeffs.dot(dictionary) + noise*rng.randn(nstims, dim)
+    return dictionary, data/data.std()
+
+
+def recovery(learned, true, cutoff=0.9):
+    """Returns (mean over true elements of the best |cosine| with a learned element,
+    fraction of true elements recovered with |cosine| above cutoff)."""
+    learned = learned/np.linalg.norm(learned, axis=1)[:,np.newaxis]
+    best = np.max(np.abs(true.dot(learned.T)), axis=1)
+    return float(best.mean()), float(np.mean(best > cutoff))
+
+
+def infer_all(learner, X):
+    """Infer coefficients for every column of X, one batch_size chunk at a time."""
+    batch = learner.batch_size
+    return np.concatenate([learner.infer(X[:, ii:ii+batch])[0] for ii in range(0, X.shape[1], batch)], axis=1)
+
+
+def learner_seed(seed):
+    """The seed for learners trained on ground_truth(seed=seed) data. It comes
+    from a separate stream, since with the same seed every random initial
+    dictionary would be the true dictionary."""
+    return int(np.random.SeedSequence([seed, 1]).generate_state(1)[0])
+
+
+def make_learners(names, data, nunits, batch_size, seed=0, init='random'):
+    """Build the named learners on the same vector data (an identity PCA stands in for real PCs).
+    A name like LCALearner+adam gives the learner that dictupdate updater.
+    seed is the one the data came from; the learners draw from learner_seed(seed)."""
+    dim = data.shape[1]
+    pca = spectrodata.ArrayPCA(np.eye(dim), np.ones(dim), np.zeros(dim), whiten=False)
+    common = dict(datatype='spectro', pca=pca, stimshape=(dim, 1), batch_size=batch_size, init=init)
+    builders = {
+        'LCALearner': lambda: LCALearner.LCALearner(data, nunits, min_thresh=0.2, max_iter=1, niter=100, **common),
+        'HomeostaticLCA': lambda: LCAmods.HomeostaticLCA(data, nunits, min_thresh=0.2, max_iter=1, niter=100,
+                                                         firingrate=0.1, **common),
+        'HomeoPositiveLCA': lambda: LCAmods.HomeoPositiveLCA(data, nunits, min_thresh=0.2, max_iter=1, niter=100,
+                                                             firingrate=0.1, **common),
+        'PositiveLCA': lambda: LCAmods.PositiveLCA(data, nunits, min_thresh=0.2, max_iter=1, niter=100, **common),
+        'FISTALearner': lambda: FISTALearner.FISTALearner(data, 1./batch_size, nunits, lam=0.2, niter=50, **common),
+        'Sparsenet': lambda: sparsenet.Sparsenet(data, nunits, learnrate=1./batch_size, lamb=0.2, **common),
+    }
+    learners = {}
+    for name in names:
+        np.random.seed(learner_seed(seed))
+        kind, _, updater = name.partition('+')
+        if kind not in builders:
+            raise ValueError("Unknown learner " + kind + "; choose from " + ", ".join(builders))
+        learners[name] = builders[kind]()
+        learners[name].updater = dictupdate.make_updater(updater or None)
+    return learners
+
+
+def train_with_checkpoints(learner, Xtest, truedict, ntrials, every):
+    curve = {'trials': [], 'seconds': [], 'snr': [], 'recovery': [], 'recovered': []}
+    seconds = 0.
+    for start in range(0, ntrials, every):
+        t = time.perf_counter()
+        learner.run(ntrials=min(every, ntrials-start))
+        seconds += time.perf_counter() - t
+        snr = learner.snr(Xtest, infer_all(learner, Xtest))
+        meancos, recovered = recovery(learner.Q, truedict)
+        for key, value in zip(curve, (min(start+every, ntrials), seconds, float(snr), meancos, recovered)):
+            curve[key].append(value)
+    return curve
+
+
+def first_reaching(curve, target):
+    """(seconds, trials) at the first checkpoint with SNR at least target, or (None, None)."""
+    for seconds, trials, snr in zip(curve['seconds'], curve['trials'], curve['snr']):
+        if snr >= target:
+            return seconds, trials
+    return None, None
+
+
+def summary(curves, target):
+    lines = ["{:<16}{:>12}{:>12}{:>12}{:>12}{:>12}".format('learner', 'time to ' + str(target), 'trials to',
+                                                         'final SNR', 'mean |cos|', 'recovered')]
+    for name, curve in curves.items():
+        seconds, trials = first_reaching(curve, target)
+        lines.append("{:<16}{:>12}{:>12}{:>12.2f}{:>12.3f}{:>12.2f}".format(
+            name, 'never' if seconds is None else '{:.1f} s'.format(seconds),
+            '-' if trials is None else str(trials),
+            curve['snr'][-1], curve['recovery'][-1], curve['recovered'][-1]))
+    return '\n'.join(lines)
+
+
+def plot(curves, filename):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    fig, axes = plt.subplots(1, 2, figsize=(10, 4))
+    for name, curve in curves.items():
+        axes[0].plot(curve['seconds'], curve['snr'], label=name)
+        axes[1].plot(curve['seconds'], curve['recovery'], label=name)
+    axes[0].set_ylabel('Held-out SNR')
+    axes[1].set_ylabel('Mean best |cosine| with true elements')
+    for ax in axes:
+        ax.set_xlabel('Training time (s)')
+    axes[0].legend()
+    fig.savefig(filename, bbox_inches='tight')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare dictionary learners by time to reach a target quality.")
+    parser.add_argument('-l', '--learners', nargs='*', default=['LCALearner', 'LCALearner+online', 'LCALearner+adam', 'HomeostaticLCA', 'FISTALearner', 'Sparsenet'])
+    parser.add_argument('-n', '--ntrials', default=2000, type=int)
+    parser.add_argument('-e', '--every', default=200, type=int)
+    parser.add_argument('-d', '--dim', default=64, type=int)
+    parser.add_argument('-u', '--nunits', default=128, type=int)
+    parser.add_argument('-b', '--batch_size', default=100, type=int)
+    parser.add_argument('-t', '--target', default=20., type=float)
+    parser.add_argument('-o', '--output', default=None, type=str)
+    parser.add_argument('--plot', default=None, type=str)
+    parser.add_argument('--init', default='random', type=str, choices=DictLearner.INIT_METHODS)
+    args = parser.parse_args()
+
+    truedict, data = ground_truth(args.dim, args.nunits)
+    ntest = 1000
+    Xtest, Xtrain = data[:ntest].T, data[ntest:]
+    learners = make_learners(args.learners, Xtrain, args.nunits, args.batch_size, init=args.init)
+    curves = {}
+    for name, learner in learners.items():
+        print("Training " + name)
+        curves[name] = train_with_checkpoints(learner, Xtest, truedict, args.ntrials, args.every)
+    print(summary(curves, args.target))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'curves': curves}, f, indent=1)
+    if args.plot is not None:
+        plot(curves, args.plot)
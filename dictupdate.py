@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+Dictionary update rules that can stand in for the gradient step in
+DictLearner.learn. Set a learner's updater attribute to one of these and
+learn hands every batch of data and coefficients to it; with updater None
+(the default) learn takes its usual gradient step.
+
+OnlineUpdater solves for the dictionary from running statistics. The
+GradientUpdater subclasses (momentum, Nesterov, Adam, per-element AdaGrad)
+change only how the gradient becomes a step; the theta term and the
+normalization are applied as before.
+
+Updaters keep whatever state they need per dictionary element, allocate it
+on the first batch, and are saved along with the learner's dictionary. The
+learner keeps that state in step with its units through permute, reset_units
+and grow.
+"""
+import numpy as np
+
+
+class OnlineUpdater(object):
+    """Online dictionary learning as in Mairal, Bach, Ponce and Sapiro (2010).
+    Keeps running sums A = sum of s s^T (units x units) and B = sum of s x^T
+    (units x datasize) over all the batches seen, and after each batch does one
+    pass of block-coordinate descent on the dictionary, which minimizes the
+    squared error of all past batches given their coefficients. There is no
+    learning rate.
+
+    Past batches were encoded with older dictionaries, so their statistics are
+    down-weighted by beta = (1 - 1/t)**rho at batch t. After t batches, batch i
+    then has weight proportional to (i/t)**rho: rho=0 weighs every batch the
+    same, as in the basic algorithm, and larger rho forgets faster. The
+    default rho=1 (weights rising linearly with i) phases out the first
+    batches, which were coded with a nearly random dictionary; on synthetic
+    data it recovers the true elements slightly better than rho=0."""
+
+    def __init__(self, rho=1., eps=1e-10):
+        self.rho = rho
+        self.eps = eps
+        self.reset()
+
+    def reset(self):
+        self.A = None
+        self.B = None
+        self.t = 0
+
+    def update(self, learner, data, coeffs, normalize=True, weights=None):
+        """Accumulate the statistics of this batch, with each stimulus weighted
+        by weights if given, and update learner.Q.
+        Returns the mean-squared error before the update."""
+        Q = learner.Q
+        R = data.T - np.dot(coeffs.T, Q)
+        nstim = data.shape[1]
+        wcoeffs = coeffs if weights is None else coeffs*weights
+        if self.A is None or self.A.shape[0] != Q.shape[0]:
+            self.A = np.zeros((Q.shape[0], Q.shape[0]))
+            self.B = np.zeros_like(Q)
+            self.t = 0
+        self.t += 1
+        beta = (1. - 1./self.t)**self.rho
+        self.A *= beta
+        self.A += wcoeffs.dot(coeffs.T)/nstim
+        self.B *= beta
+        self.B += wcoeffs.dot(data.T)/nstim
+
+        Q = Q.copy()
+        for j in range(Q.shape[0]):
+            if self.A[j,j] < self.eps:
+                # never used, nothing to fit
+                continue
+            Q[j] += (self.B[j] - self.A[j].dot(Q))/self.A[j,j]
+            norm = np.linalg.norm(Q[j])
+            if normalize:
+                Q[j] /= norm
+            elif norm > 1:
+                # project onto the unit ball, as in the original algorithm
+                Q[j] /= norm
+        learner.Q = Q
+        if weights is None:
+            return np.mean(R**2)
+        return np.einsum('ij,ij->i', R, R).dot(weights)/R.size
+
+    def permute(self, order):
+        """Reorder (or select) the per-element statistics to follow learner.sort."""
+        if self.A is not None:
+            self.A = self.A[np.ix_(order, order)]
+            self.B = self.B[order]
+            
+    def reset_units(self, units):
+        """Forget the statistics of the given elements, which have been replaced."""
+        if self.A is not None:
+            self.A[units,:] = 0
+            self.A[:,units] = 0
+            self.B[units] = 0
+            
+    def grow(self, nnew):
+        """Make room for nnew elements appended to the dictionary, with no statistics yet."""
+        if self.A is not None:
+            self.A = np.pad(self.A, ((0, nnew), (0, nnew)))
+            self.B = np.pad(self.B, ((0, nnew), (0, 0)))
+
+
+class GradientUpdater(object):
+    """Base class for optimizers of the gradient step in DictLearner.learn.
+    Subclasses turn the gradient (summed over the batch) into a step using
+    state that has one row per dictionary element, listed in _state, and
+    the step size learnrate, which defaults to the learner's own learnrate so
+    that rate_decay still works. The theta term and normalization are then
+    applied as in learn."""
+    _state = ()
+
+    def __init__(self, learnrate=None):
+        self.learnrate = learnrate
+        self.reset()
+
+    def reset(self):
+        for name in self._state:
+            setattr(self, name, None)
+        self.t = 0
+
+    def update(self, learner, data, coeffs, normalize=True, weights=None):
+        gradient, mse = learner._gradient(data, coeffs, weights)
+        first = getattr(self, self._state[0])
+        if first is None or first.shape[0] != gradient.shape[0]:
+            for name in self._state:
+                setattr(self, name, np.zeros((gradient.shape[0], self._state_width(gradient))))
+            self.t = 0
+        self.t += 1
+        rate = self.learnrate if self.learnrate is not None else learner.learnrate
+        learner._apply_update(self.step(gradient, rate), normalize)
+        return mse
+
+    def _state_width(self, gradient):
+        return gradient.shape[1]
+
+    def step(self, gradient, rate):
+        raise NotImplementedError
+
+    def permute(self, order):
+        """Reorder (or select) the per-element state to follow learner.sort."""
+        for name in self._state:
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, value[order])
+                
+    def reset_units(self, units):
+        """Forget the state of the given elements, which have been replaced."""
+        for name in self._state:
+            value = getattr(self, name)
+            if value is not None:
+                value[units] = 0
+                
+    def grow(self, nnew):
+        """Add zero state for nnew elements appended to the dictionary."""
+        for name in self._state:
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, np.pad(value, ((0, nnew), (0, 0))))
+
+
+class MomentumUpdater(GradientUpdater):
+    """Gradient descent with heavy-ball momentum, or Nesterov momentum if nesterov."""
+    _state = ('velocity',)
+
+    def __init__(self, momentum=0.9, nesterov=False, learnrate=None):
+        self.momentum = momentum
+        self.nesterov = nesterov
+        super().__init__(learnrate)
+
+    def step(self, gradient, rate):
+        # the velocity is a moving average of steps, so the step size stays comparable to plain descent
+        self.velocity *= self.momentum
+        self.velocity += (1-self.momentum)*rate*gradient
+        if self.nesterov:
+            return self.momentum*self.velocity + (1-self.momentum)*rate*gradient
+        return self.velocity.copy()
+
+
+class AdamUpdater(GradientUpdater):
+    """Adam (Kingma and Ba, 2015): steps scaled per entry by running estimates
+    of the first and second moments of the gradient, with bias correction."""
+    _state = ('m', 'v')
+
+    def __init__(self, beta1=0.9, beta2=0.999, eps=1e-8, learnrate=None):
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.eps = eps
+        super().__init__(learnrate)
+
+    def step(self, gradient, rate):
+        self.m *= self.beta1
+        self.m += (1-self.beta1)*gradient
+        self.v *= self.beta2
+        self.v += (1-self.beta2)*gradient**2
+        mhat = self.m/(1-self.beta1**self.t)
+        vhat = self.v/(1-self.beta2**self.t)
+        return rate*mhat/(np.sqrt(vhat) + self.eps)
+
+
+class AtomAdaGradUpdater(GradientUpdater):
+    """AdaGrad with one step size per dictionary element, from the accumulated
+    squared norm of that element's gradient. Rarely used elements keep large
+    steps while busy ones settle. With decay, the accumulation is a moving
+    average instead of a sum (as in RMSprop). Steps are normalized, so
+    learnrate is roughly the length of each element's first step and does
+    not follow the learner's learnrate."""
+    _state = ('accum',)
+
+    def __init__(self, decay=None, eps=1e-8, learnrate=1.):
+        self.decay = decay
+        self.eps = eps
+        super().__init__(learnrate)
+
+    def _state_width(self, gradient):
+        return 1
+
+    def step(self, gradient, rate):
+        sqnorms = np.sum(gradient**2, axis=1, keepdims=True)
+        if self.decay is None:
+            self.accum += sqnorms
+        else:
+            self.accum *= self.decay
+            self.accum += (1-self.decay)*sqnorms
+        return rate*gradient/(np.sqrt(self.accum) + self.eps)
+
+
+UPDATERS = {'online': OnlineUpdater,
+            'momentum': MomentumUpdater,
+            'nesterov': lambda: MomentumUpdater(nesterov=True),
+            'adam': AdamUpdater,
+            'adagrad': AtomAdaGradUpdater}
+
+
+def make_updater(name):
+    """An updater by name (one of UPDATERS), or None for plain gradient descent."""
+    if name is None or name == 'sgd':
+        return None
+    return UPDATERS[name]()
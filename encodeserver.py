@@ -0,0 +1,445 @@
+# -*- coding: utf-8 -*-
+"""
+Local encoding service for a trained learner.
+
+The server loads a checkpoint once, puts the dictionary and its Gram matrix
+in read-only shared memory, fills the learner's other per-dictionary caches
+(step sizes, sparse patterns) with a warm-up inference, and then forks
+worker processes that run inference for it. Clients connect over TCP on
+localhost. Concurrent requests are gathered into micro-batches: a batch goes
+to a free worker once it holds max_batch stimuli or its oldest request has
+waited max_delay seconds, whichever comes first.
+
+Protocol: a request is a header of two little-endian uint32, the number of
+stimuli n and the data size, followed by n*datasize float64 values (one
+stimulus after another). The reply has the header n, nunits and then
+n*nunits float64 coefficients. A connection can send any number of requests
+and gets the replies in order. A request the server cannot serve (the wrong
+data size, more than max_request stimuli, or a failed inference) gets the
+header ERROR, length and then a UTF-8 message of that many bytes; after a
+malformed header the server then closes the connection.
+
+Micro-batching only changes which stimuli share a call to infer. For
+FISTALearner, and for LCALearner with max_iter=1, each stimulus is inferred
+independently, so the coefficients are the same as for one request at a time.
+With the checkpoint's max_iter > 1, LCA inference repeats blocks of niter
+iterations until the mean error of the whole batch is below tolerance, so a
+code depends on the other requests it was batched with. --fixed_iters sets
+max_iter to 1, which makes codes reproducible at the price of stopping after
+niter iterations even when the checkpoint would have run more. --selftest
+always uses it, since it compares against one request at a time.
+
+Usage:
+    python encodeserver.py --learner LCALearner --checkpoint dict.pickle --port 8765
+    python encodeserver.py --selftest
+"""
+import argparse
+import asyncio
+import collections
+import json
+import multiprocessing
+import pickle
+import signal
+import socket
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import LCALearner
+import LCAmods
+import FISTALearner
+import parallel
+import spectrodata
+
+HEADER = struct.Struct('<II')
+ERROR = 0xFFFFFFFF
+
+
+def load_learner(kind, checkpoint):
+    """A learner of the named class (LCALearner, FISTALearner or a class in
+    LCAmods) holding the dictionary and parameters saved in checkpoint."""
+    with open(checkpoint, 'rb') as f:
+        nunits, datasize = pickle.load(f)[0].shape
+    # inference needs no training data, only a StimSet of the right size
+    pca = spectrodata.ArrayPCA(np.eye(datasize), np.ones(datasize), np.zeros(datasize), whiten=False)
+    common = dict(datatype='spectro', pca=pca, stimshape=(datasize, 1))
+    dummy = np.zeros((1, datasize))
+    if kind == 'FISTALearner':
+        learner = FISTALearner.FISTALearner(dummy, 0., nunits, **common)
+    else:
+        cls = LCALearner.LCALearner if kind == 'LCALearner' else getattr(LCAmods, kind)
+        learner = cls(dummy, nunits, **common)
+    learner.load(checkpoint)
+    return learner
+
+
+def share_dictionary(learner):
+    """Move learner's dictionary and Gram matrix into read-only shared memory
+    and fill its other caches, so forked workers all use the same copies."""
+    Q = parallel.shared_array(learner.Q.shape)
+    Q[:] = learner.Q
+    Q.flags.writeable = False
+    learner.Q = Q
+    G = parallel.shared_array((Q.shape[0], Q.shape[0]))
+    np.dot(Q, Q.T, out=G)
+    G.flags.writeable = False
+    learner._gram_cache = (learner.dict_version, G)
+    learner.infer(np.zeros((Q.shape[1], 2)))
+
+
+def _worker(learner, conn, X, acts, blas_threads):
+    with parallel.blas_limits(blas_threads):
+        while True:
+            try:
+                n = conn.recv()
+            except EOFError:
+                break
+            if n is None:
+                break
+            try:
+                acts[:, :n] = learner.infer(X[:, :n])[0]
+                conn.send(n)
+            except Exception as er:
+                conn.send(er)
+
+
+class _Worker(object):
+    """Input and output buffers for one batch, and the process that runs
+    inference on them (or None to run it in the calling thread)."""
+
+    def __init__(self, learner, max_batch, context=None, blas_threads=None):
+        nunits, datasize = learner.Q.shape
+        self.learner = learner
+        self.X = parallel.shared_array((datasize, max_batch))
+        self.acts = parallel.shared_array((nunits, max_batch))
+        self.conn = self.process = None
+        if context is not None:
+            parent, child = context.Pipe()
+            self.process = context.Process(target=_worker, daemon=True,
+                                           args=(learner, child, self.X, self.acts, blas_threads))
+            self.process.start()
+            child.close()
+            self.conn = parent
+
+    def run(self, n):
+        """Infer the first n columns of X into acts. Blocks until done."""
+        if self.process is None:
+            self.acts[:, :n] = self.learner.infer(self.X[:, :n])[0]
+            return
+        self.conn.send(n)
+        result = self.conn.recv()
+        if isinstance(result, Exception):
+            raise result
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.conn.close()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class EncodeServer(object):
+    """Serves learner.infer over TCP with micro-batching. nworkers processes
+    (0 for inference in a thread of this process) share the dictionary.
+    Requests of more than max_request stimuli are refused, which bounds the
+    memory one request can make the server allocate.
+    Workers are forked here, before start() opens the socket, so this needs
+    a platform with fork unless nworkers is 0."""
+
+    def __init__(self, learner, nworkers=1, max_batch=64, max_delay=0.002,
+                 host='127.0.0.1', port=0, blas_threads=None, max_request=4096):
+        self.learner = learner
+        self.nunits, self.datasize = learner.Q.shape
+        self.max_batch = max_batch
+        self.max_request = max_request
+        self.max_delay = max_delay
+        self.host = host
+        self.port = port
+        share_dictionary(learner)
+        context = multiprocessing.get_context('fork') if nworkers > 0 else None
+        if blas_threads is None and nworkers > 0:
+            blas_threads = parallel.blas_threads_per_worker(nworkers)
+        self.workers = [_Worker(learner, max_batch, context, blas_threads) for ii in range(max(nworkers, 1))]
+        self._threads = ThreadPoolExecutor(max_workers=len(self.workers))
+        self.latencies = collections.deque(maxlen=100000)
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.latencies.clear()
+        self.nrequests = 0
+        self.nstims = 0
+        self.nbatches = 0
+        self.stats_start = time.perf_counter()
+
+    def stats(self):
+        """p50 and p99 request latency (ms, from the request being read to its
+        reply being ready), throughput and batch size since reset_stats."""
+        elapsed = time.perf_counter() - self.stats_start
+        latencies = 1000*np.array(self.latencies) if self.latencies else np.full(1, np.nan)
+        return {'requests': self.nrequests, 'stimuli': self.nstims,
+                'p50_ms': float(np.percentile(latencies, 50)),
+                'p99_ms': float(np.percentile(latencies, 99)),
+                'requests_per_sec': self.nrequests/elapsed,
+                'stimuli_per_sec': self.nstims/elapsed,
+                'mean_batch': self.nstims/self.nbatches if self.nbatches else 0.}
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._idle = asyncio.Queue()
+        for worker in self.workers:
+            self._idle.put_nowait(worker)
+        # the event loop only keeps weak references to tasks, so hold on to them here
+        self._tasks = set()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._batcher = self._spawn(self._batch_loop())
+
+    async def serve_forever(self, report_every=None):
+        """Serve until SIGINT or SIGTERM, printing the stats every report_every seconds."""
+        await self.start()
+        print("Serving " + str(self.nunits) + " units on " + self.host + ":" + str(self.port), flush=True)
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(sig, stop.set)
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), report_every)
+            except asyncio.TimeoutError:
+                print(json.dumps(self.stats()), flush=True)
+                self.reset_stats()
+        await self.close()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+        self._batcher.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._threads.shutdown()
+        for worker in self.workers:
+            worker.close()
+
+    async def _handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                n, datasize = HEADER.unpack(await reader.readexactly(HEADER.size))
+                if datasize != self.datasize:
+                    await self._error(writer, "Expected data size " + str(self.datasize) + ", got " + str(datasize) + ".")
+                    break
+                if n > self.max_request:
+                    await self._error(writer, "At most " + str(self.max_request) + " stimuli per request, got " + str(n) + ".")
+                    break
+                body = await reader.readexactly(8*n*datasize)
+                arrived = time.perf_counter()
+                X = np.frombuffer(body, dtype='<f8').reshape((n, datasize))
+                # requests larger than a batch are split into batch-sized pieces
+                futures = []
+                for start in range(0, n, self.max_batch):
+                    futures.append(loop.create_future())
+                    self._queue.put_nowait((loop.time(), X[start:start+self.max_batch], futures[-1]))
+                try:
+                    acts = np.concatenate(await asyncio.gather(*futures)) if futures else np.zeros((0, self.nunits))
+                except Exception as er:
+                    await self._error(writer, "Inference failed: " + repr(er))
+                    continue
+                self.latencies.append(time.perf_counter() - arrived)
+                self.nrequests += 1
+                self.nstims += n
+                writer.write(HEADER.pack(n, self.nunits) + acts.astype('<f8').tobytes())
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _error(writer, message):
+        message = message.encode('utf-8')
+        writer.write(HEADER.pack(ERROR, len(message)) + message)
+        await writer.drain()
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        held = None
+        while True:
+            first = held if held is not None else await self._queue.get()
+            held = None
+            batch = [first]
+            size = len(first[1])
+            deadline = first[0] + self.max_delay
+            while size < self.max_batch:
+                try:
+                    if self._queue.empty():
+                        timeout = deadline - loop.time()
+                        if timeout <= 0:
+                            break
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    else:
+                        item = self._queue.get_nowait()
+                except asyncio.TimeoutError:
+                    break
+                if size + len(item[1]) > self.max_batch:
+                    held = item
+                    break
+                batch.append(item)
+                size += len(item[1])
+            worker = await self._idle.get()
+            self._spawn(self._run(worker, batch, size))
+
+    def _spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print("Encode server task failed: " + repr(task.exception()), flush=True)
+
+    async def _run(self, worker, batch, size):
+        try:
+            start = 0
+            for arrived, X, future in batch:
+                worker.X[:, start:start+len(X)] = X.T
+                start += len(X)
+            await asyncio.get_running_loop().run_in_executor(self._threads, worker.run, size)
+        except Exception as er:
+            # fail the requests rather than leave them waiting
+            for arrived, X, future in batch:
+                future.set_exception(er)
+        else:
+            start = 0
+            for arrived, X, future in batch:
+                future.set_result(worker.acts[:, start:start+len(X)].T.copy())
+                start += len(X)
+            self.nbatches += 1
+        finally:
+            self._idle.put_nowait(worker)
+
+
+class EncodeError(Exception):
+    """The server refused a request; the message is its reply."""
+
+
+def _recv_exactly(sock, nbytes):
+    buf = bytearray(nbytes)
+    view = memoryview(buf)
+    while nbytes:
+        got = sock.recv_into(view, nbytes)
+        if got == 0:
+            raise ConnectionError("Server closed the connection.")
+        view = view[got:]
+        nbytes -= got
+    return buf
+
+
+class EncodeClient(object):
+    """Blocking client for EncodeServer."""
+
+    def __init__(self, host='127.0.0.1', port=8765):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def encode(self, X):
+        """Coefficients (nunits x n) for the stimuli in the columns of X, as infer."""
+        X = np.asarray(X, dtype='<f8').reshape((X.shape[0], -1))
+        self.sock.sendall(HEADER.pack(X.shape[1], X.shape[0]) + X.T.tobytes())
+        n, nunits = HEADER.unpack(_recv_exactly(self.sock, HEADER.size))
+        if n == ERROR:
+            raise EncodeError(_recv_exactly(self.sock, nunits).decode('utf-8'))
+        acts = np.frombuffer(_recv_exactly(self.sock, 8*n*nunits), dtype='<f8')
+        return acts.reshape((n, nunits)).T
+
+    def close(self):
+        self.sock.close()
+
+
+async def _client(host, port, stims):
+    """Send the columns of stims one at a time over one connection; returns their coefficients."""
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    results = []
+    for ii in range(stims.shape[1]):
+        writer.write(HEADER.pack(1, stims.shape[0]) + stims[:, ii].astype('<f8').tobytes())
+        n, nunits = HEADER.unpack(await reader.readexactly(HEADER.size))
+        if n == ERROR:
+            raise EncodeError((await reader.readexactly(nunits)).decode('utf-8'))
+        results.append(np.frombuffer(await reader.readexactly(8*n*nunits), dtype='<f8'))
+    writer.close()
+    return np.array(results).T
+
+
+async def load_test(server, stims, nclients):
+    """Split the columns of stims among nclients concurrent connections that
+    each send one stimulus per request. Returns (coefficients, server stats)."""
+    await server.start()
+    server.reset_stats()
+    shards = np.array_split(np.arange(stims.shape[1]), nclients)
+    results = await asyncio.gather(*[_client(server.host, server.port, stims[:, shard]) for shard in shards])
+    stats = server.stats()
+    await server.close()
+    acts = np.zeros((server.nunits, stims.shape[1]))
+    for shard, result in zip(shards, results):
+        acts[:, shard] = result
+    return acts, stats
+
+
+def selftest(learner, nworkers, max_batch, max_delay, nclients, nstims):
+    """Serve learner on localhost, encode nstims random stimuli through
+    nclients concurrent clients, check the coefficients against learner.infer
+    and compare with encoding one request at a time in this process."""
+    stims = learner.stims.rand_stim(batch_size=nstims)
+    t = time.perf_counter()
+    expected = np.concatenate([learner.infer(stims[:, ii:ii+1])[0] for ii in range(nstims)], axis=1)
+    serial = nstims/(time.perf_counter() - t)
+    server = EncodeServer(learner, nworkers, max_batch, max_delay)
+    acts, stats = asyncio.run(load_test(server, stims, nclients))
+    error = np.max(np.abs(acts - expected))
+    print(json.dumps(stats))
+    print("One request at a time: {:.1f} stimuli/s; served: {:.1f} stimuli/s".format(serial, stats['stimuli_per_sec']))
+    print("Largest difference from learner.infer: " + str(error))
+    return error < 1e-6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve sparse codes from a trained dictionary on localhost.")
+    parser.add_argument('-l', '--learner', default='LCALearner', type=str)
+    parser.add_argument('-c', '--checkpoint', default=None, type=str)
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('-p', '--port', default=8765, type=int)
+    parser.add_argument('-w', '--nworkers', default=1, type=int)
+    parser.add_argument('-b', '--max_batch', default=64, type=int)
+    parser.add_argument('-d', '--max_delay', default=2., type=float, help='milliseconds')
+    parser.add_argument('--max_request', default=4096, type=int, help='most stimuli in one request')
+    parser.add_argument('--report_every', default=10., type=float, help='seconds between stats lines')
+    parser.add_argument('--fixed_iters', action='store_true',
+                        help='run exactly niter iterations per stimulus, so codes do not depend on batching')
+    parser.add_argument('--selftest', action='store_true')
+    parser.add_argument('--nclients', default=32, type=int)
+    parser.add_argument('--nstims', default=2000, type=int)
+    args = parser.parse_args()
+
+    if args.checkpoint is not None:
+        learner = load_learner(args.learner, args.checkpoint)
+    elif args.selftest:
+        import compare_learners
+        truedict, data = compare_learners.ground_truth()
+        learner = compare_learners.make_learners([args.learner], data, truedict.shape[0], args.max_batch)[args.learner]
+    else:
+        raise SystemExit("Need a --checkpoint to serve.")
+    if (args.fixed_iters or args.selftest) and hasattr(learner, 'max_iter'):
+        # a tolerance shared by the batch would make codes depend on the other requests
+        learner.max_iter = 1
+    if args.selftest:
+        ok = selftest(learner, args.nworkers, args.max_batch, args.max_delay/1000., args.nclients, args.nstims)
+        raise SystemExit(0 if ok else 1)
+    server = EncodeServer(learner, args.nworkers, args.max_batch, args.max_delay/1000., args.host, args.port,
+                          max_request=args.max_request)
+    asyncio.run(server.serve_forever(args.report_every))
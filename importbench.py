@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Measures how long it takes to import the learner modules in a fresh interpreter.
+
+Each module is timed twice: as it is now, and with matplotlib.pyplot imported
+first, which is what every import cost before plotting was made lazy. The
+difference is the startup time saved on headless nodes and sweep workers.
+
+Usage:
+    python importbench.py -n 5
+"""
+import argparse
+import os
+import subprocess
+import sys
+import numpy as np
+
+MODULES = ['StimSet', 'DictLearner', 'LCALearner', 'LCAmods', 'FISTALearner', 'sparsenet']
+
+TIMER = """
+import time
+t = time.perf_counter()
+{pre}
+import {module}
+t = time.perf_counter() - t
+import sys
+print(t, 'matplotlib.pyplot' in sys.modules)
+"""
+
+
+def time_import(module, eager=False):
+    """Returns (seconds, whether pyplot got loaded) for importing module in a new process."""
+    pre = 'import matplotlib.pyplot' if eager else ''
+    env = dict(os.environ, MPLBACKEND='Agg')
+    out = subprocess.check_output([sys.executable, '-c', TIMER.format(pre=pre, module=module)],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+    seconds, pyplot = out.split()[-2:]
+    return float(seconds), pyplot == b'True'
+
+
+def run(modules=MODULES, repeats=5):
+    print("{:<14}{:>12}{:>12}{:>10}  {}".format('module', 'lazy (ms)', 'eager (ms)', 'speedup', 'pyplot loaded'))
+    results = {}
+    for module in modules:
+        lazy = [time_import(module) for ii in range(repeats)]
+        eager = [time_import(module, eager=True)[0] for ii in range(repeats)]
+        lazytime = np.median([t for t, _ in lazy])
+        eagertime = np.median(eager)
+        results[module] = (lazytime, eagertime)
+        print("{:<14}{:>12.1f}{:>12.1f}{:>9.1f}x  {}".format(module, 1000*lazytime, 1000*eagertime,
+                                                            eagertime/lazytime, lazy[0][1]))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time imports of the learner modules in fresh interpreters.")
+    parser.add_argument('-n', '--repeats', default=5, type=int)
+    parser.add_argument('-m', '--modules', nargs='*', default=MODULES)
+    args = parser.parse_args()
+    run(args.modules, args.repeats)
@@ -5,13 +5,10 @@ Created on Tue Dec  8 13:32:07 2015
 @author: Eric
 """
 import time
-import scipy.io as io
 #import pickle
 import LCALearner
 import numpy as np
-import sys
-import pca.pca
-sys.modules['pca'] = pca.pca #this is a workaround to get the pickled pca to load.  I think it basically tells python that pca.pca is an acceptable name for pca
+import spectrodata
 
 #images = scipy.io.loadmat('../SAILnet/PythonSAILnet/Data/Images.mat')["IMAGES"]
 #lca = LCALearner.LCALearner(images, nunits=300, learn_rate = .001, batch_size=100, infrate=.01, niter=100,
@@ -34,16 +31,7 @@ numunits = int(overcompleteness*numinput)
 #scale = np.std(spectros)
 #spectros = spectros/scale
 
-stuff = io.loadmat('../audition/Nicole Code/PCAmatrices2.mat')
-mypca = pca.pca.PCA(dim=200,whiten=True)
-mypca.eVectors = stuff['E'].T
-mypca.sValues = np.sqrt(np.diag(np.abs(stuff['D1'])))
-mypca.sValues = mypca.sValues[::-1]
-mypca.mean_vec = np.zeros(6400)
-mypca.ready=True
-origshape = (25,256)
-
-spectros = io.loadmat('../audition/Nicole Code/dMatPCA2.mat')['dMatPCA'].T
+spectros, mypca, origshape = spectrodata.load_or_build('../audition/Nicole Code/', '2', flip=False)
 
 lca = LCALearner.LCALearner(spectros, numunits, datatype="spectro", pca = mypca,  stimshape=origshape, paramfile='dummy')
 
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Data-parallel training for DictLearner.run.
+
+Each worker process samples and infers its own shard of every batch against
+the dictionary, which lives in memory shared with the parent. The workers
+write their stimuli and coefficients into shared buffers, and the parent
+runs learn once on the whole batch. Since the gradient in learn is a sum over
+the batch, this is the same as reducing the workers' gradients, and the
+dictionary is normalized once per step. Updates are synchronous.
+
+Workers are forked, so they start with a copy of the learner and its data
+without pickling anything. This needs a platform with fork.
+"""
+import contextlib
+import mmap
+import multiprocessing
+import os
+import warnings
+import numpy as np
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+def shared_array(shape, dtype=np.float64):
+    """An array in anonymous shared memory. Processes forked after it is
+    created see the same memory, so writes in one show up in the others."""
+    dtype = np.dtype(dtype)
+    nbytes = max(int(np.prod(shape))*dtype.itemsize, 1)
+    return np.frombuffer(mmap.mmap(-1, nbytes), dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+_warned_no_threadpoolctl = False
+
+
+def blas_limits(nthreads):
+    """Context manager that limits BLAS to nthreads threads, if threadpoolctl is
+    installed. Without it this does nothing, and every worker's BLAS may start
+    a thread per core; that is warned about once."""
+    global _warned_no_threadpoolctl
+    if nthreads is None:
+        return contextlib.nullcontext()
+    if threadpool_limits is None:
+        if not _warned_no_threadpoolctl:
+            warnings.warn("threadpoolctl is not installed, so BLAS threads cannot be limited "
+                          "and parallel workers may oversubscribe the cores; pip install threadpoolctl",
+                          RuntimeWarning, stacklevel=2)
+            _warned_no_threadpoolctl = True
+        return contextlib.nullcontext()
+    return threadpool_limits(nthreads, user_api='blas')
+
+
+def blas_threads_per_worker(nworkers):
+    """Share the cores among nworkers so that BLAS inside them does not oversubscribe."""
+    return max(1, (os.cpu_count() or 1)//nworkers)
+
+
+def shard_bounds(n, nshards, minsize=1):
+    """(start, stop) pairs splitting range(n) into at most nshards pieces of at least minsize."""
+    nshards = max(1, min(nshards, n//minsize))
+    bounds = np.linspace(0, n, nshards+1).astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _worker(learner, conn, Q, X, acts, start, stop, seed, blas_threads):
+    np.random.seed(seed)
+    if threadpool_limits is not None and blas_threads is not None:
+        threadpool_limits(blas_threads)
+    while True:
+        try:
+            state = conn.recv()
+        except EOFError:
+            break
+        if state is None:
+            break
+        try:
+            for name, value in state.items():
+                setattr(learner, name, value)
+            # Q is updated in place by the parent, so reassign it to bump dict_version
+            learner.Q = Q
+            stims = learner.stims.rand_stim(batch_size=stop-start)
+            X[:, start:stop] = stims
+            acts[:, start:stop] = learner.infer(stims)[0]
+            conn.send(learner.infer_iters)
+        except Exception as er:
+            conn.send(er)
+
+
+class DataParallelRunner(object):
+    """Runs sampling and inference for learner's batches in nworkers processes.
+    Call step() for each batch, then sync() after the parent has updated Q."""
+
+    def __init__(self, learner, nworkers, batch_size=None, blas_threads=1):
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            raise ValueError("Data-parallel training needs the fork start method.")
+        batch_size = batch_size or learner.batch_size
+        if nworkers > batch_size:
+            raise ValueError("Need at least one stimulus per worker.")
+        self.learner = learner
+        self.nunits, datasize = learner.Q.shape
+        self.Q = shared_array(learner.Q.shape)
+        self.Q[:] = learner.Q
+        self.X = shared_array((datasize, batch_size))
+        self.acts = shared_array((self.nunits, batch_size))
+
+        bounds = np.linspace(0, batch_size, nworkers+1).astype(int)
+        seeds = np.random.randint(2**31, size=nworkers)
+        self.conns = []
+        self.processes = []
+        for ii in range(nworkers):
+            parent, child = context.Pipe()
+            process = context.Process(target=_worker, daemon=True,
+                                      args=(learner, child, self.Q, self.X, self.acts,
+                                            bounds[ii], bounds[ii+1], seeds[ii], blas_threads))
+            process.start()
+            child.close()
+            self.conns.append(parent)
+            self.processes.append(process)
+
+    def step(self):
+        """Have every worker sample and infer its shard. Returns (X, acts) for
+        the whole batch; they are overwritten by the next step."""
+        if self.learner.Q.shape[0] != self.nunits:
+            raise ValueError("The number of units changed; start a new DataParallelRunner.")
+        state = self.learner._parallel_state()
+        for conn in self.conns:
+            conn.send(state)
+        iters = []
+        for conn in self.conns:
+            result = conn.recv()
+            if isinstance(result, Exception):
+                raise result
+            iters.append(result)
+        self.learner.infer_iters = max(iters)
+        return self.X, self.acts
+
+    def sync(self):
+        """Copy the learner's updated dictionary into shared memory."""
+        self.Q[:] = self.learner.Q
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            conn.close()
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
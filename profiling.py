@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Timing, metrics and profiling helpers for DictLearner.run.
+
+PhaseTimer accumulates wall time per named phase of a trial with one
+perf_counter call per phase. JSONLWriter is a metrics callback that writes
+one json object per line. TrialProfiler runs cProfile, or a simple sampling
+profiler, over a window of trials. InferenceTrace records how quantities
+evolve over the iterations of inference.
+"""
+import json
+import sys
+import threading
+import time
+from collections import Counter
+import numpy as np
+
+
+class PhaseTimer(object):
+    """Accumulates time spent in named phases. Call start() at the beginning of
+    a trial and lap(phase) at the end of each phase. Times add up both in
+    totals (which may be a dict owned by someone else) and in a window that
+    flush() returns and resets."""
+
+    def __init__(self, totals=None):
+        self.totals = totals if totals is not None else {}
+        self.window = {}
+        self.wstart = time.perf_counter()
+        self._t = self.wstart
+
+    def start(self):
+        self._t = time.perf_counter()
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        elapsed = now - self._t
+        self.totals[phase] = self.totals.get(phase, 0.) + elapsed
+        self.window[phase] = self.window.get(phase, 0.) + elapsed
+        self._t = now
+
+    def flush(self):
+        """Returns (phase times in the window, wall time since the last flush)."""
+        now = time.perf_counter()
+        window, wall = self.window, now - self.wstart
+        self.window = {}
+        self.wstart = now
+        return window, wall
+
+
+class JSONLWriter(object):
+    """Metrics callback that appends each metrics dict as a line of json."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'a')
+
+    def __call__(self, metrics):
+        self.file.write(json.dumps(metrics) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class _Sampler(object):
+    """Samples the stack of a thread at a fixed interval and counts where it is."""
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.leaf = Counter()
+        self.cumulative = Counter()
+        self.nsamples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.nsamples += 1
+            self.leaf[self._where(frame)] += 1
+            seen = set()
+            while frame is not None:
+                where = self._where(frame)
+                if where not in seen:
+                    self.cumulative[where] += 1
+                    seen.add(where)
+                frame = frame.f_back
+
+    @staticmethod
+    def _where(frame):
+        code = frame.f_code
+        return "{}:{}({})".format(code.co_filename, code.co_firstlineno, code.co_name)
+
+    def enable(self):
+        self._thread.start()
+
+    def disable(self):
+        self._stop.set()
+        self._thread.join()
+
+    def report(self, nlines=15):
+        lines = ["{} samples every {:.1f} ms".format(self.nsamples, 1000*self.interval),
+                 "{:>8} {:>8}  function".format('self %', 'cum %')]
+        total = max(self.nsamples, 1)
+        for where, count in self.cumulative.most_common(nlines):
+            lines.append("{:>8.1f} {:>8.1f}  {}".format(100*self.leaf[where]/total, 100*count/total, where))
+        return '\n'.join(lines)
+
+
+class TrialProfiler(object):
+    """Profiles trials start (inclusive) to stop (exclusive) of a run.
+    kind is 'cprofile' or 'sample'. The report is printed when the window
+    closes and written to filename if one is given (for cProfile, the raw
+    stats are dumped there for pstats/snakeviz instead)."""
+
+    def __init__(self, start, stop, filename=None, kind='cprofile', interval=0.005, nlines=15):
+        if kind not in ('cprofile', 'sample'):
+            raise ValueError("kind must be 'cprofile' or 'sample'.")
+        self.start = start
+        self.stop = stop
+        self.filename = filename
+        self.kind = kind
+        self.interval = interval
+        self.nlines = nlines
+        self.profiler = None
+        self.report = None
+
+    def step(self, trial):
+        """Call at the beginning of each trial."""
+        if trial == self.start and self.profiler is None:
+            if self.kind == 'cprofile':
+                import cProfile
+                self.profiler = cProfile.Profile()
+            else:
+                self.profiler = _Sampler(threading.get_ident(), self.interval)
+            self.profiler.enable()
+        elif trial == self.stop:
+            self.close()
+
+    def close(self):
+        """Stop profiling, if it is on, and report."""
+        if self.profiler is None or self.report is not None:
+            return
+        self.profiler.disable()
+        if self.kind == 'cprofile':
+            import io
+            import pstats
+            stream = io.StringIO()
+            stats = pstats.Stats(self.profiler, stream=stream)
+            stats.sort_stats('cumulative').print_stats(self.nlines)
+            self.report = stream.getvalue()
+            if self.filename is not None:
+                stats.dump_stats(self.filename)
+        else:
+            self.report = self.profiler.report(self.nlines)
+            if self.filename is not None:
+                with open(self.filename, 'w') as f:
+                    f.write(self.report)
+        print("Profile of trials " + str(self.start) + " to " + str(self.stop) + ":")
+        print(self.report)
+
+
+class InferenceTrace(object):
+    """Records quantities at every stride-th iteration of inference into
+    preallocated arrays. Inference methods take a trace keyword and call
+    start, record and finish on it; when no trace is given they skip all of
+    this, so tracing costs nothing when it is off.
+
+    Quantities:
+        error: mean normalized squared reconstruction error (compute_errors)
+        energy: mean of the learner's energy function (DictLearner.energy)
+        active: fraction of coefficients that are nonzero
+        thresh: mean threshold (nan for learners without one)
+    """
+    QUANTITIES = ('error', 'energy', 'active', 'thresh')
+
+    def __init__(self, quantities=('error',), stride=1):
+        for quantity in quantities:
+            if quantity not in self.QUANTITIES:
+                raise ValueError("Unknown quantity " + str(quantity))
+        self.quantities = tuple(quantities)
+        self.stride = stride
+        self.start()
+
+    def start(self, maxiter=100):
+        """Allocate room for maxiter iterations. The arrays grow if inference runs longer."""
+        size = maxiter//self.stride + 1
+        self.iterations = np.zeros(size, dtype=int)
+        self.values = {quantity: np.full(size, np.nan) for quantity in self.quantities}
+        self.nrecorded = 0
+        self.niter = 0
+
+    def _grow(self):
+        self.iterations = np.concatenate((self.iterations, np.zeros_like(self.iterations)))
+        for quantity in self.quantities:
+            self.values[quantity] = np.concatenate((self.values[quantity],
+                                                    np.full(len(self.values[quantity]), np.nan)))
+
+    def record(self, k, learner, X, acts, thresh=None):
+        """Record the requested quantities for iteration k, given the current
+        coefficients acts (units x stimuli), if k falls on the stride."""
+        if k % self.stride:
+            return
+        if self.nrecorded == len(self.iterations):
+            self._grow()
+        ii = self.nrecorded
+        self.iterations[ii] = k
+        for quantity in self.quantities:
+            if quantity == 'error':
+                value = np.mean(learner.compute_errors(acts, X))
+            elif quantity == 'energy':
+                value = learner.energy(X, acts, thresh)
+            elif quantity == 'active':
+                value = np.mean(acts != 0)
+            else:
+                value = np.nan if thresh is None else np.mean(thresh)
+            self.values[quantity][ii] = value
+        self.nrecorded = ii+1
+
+    def finish(self, niter):
+        """Note the total number of iterations inference used."""
+        self.niter = niter
+
+    def __getitem__(self, quantity):
+        return self.values[quantity][:self.nrecorded]
+
+    def converged_at(self, quantity='error', rtol=0.01):
+        """The first recorded iteration from which the quantity stays within
+        rtol (relative) of its final value, or None if it was not recorded."""
+        if quantity not in self.values or self.nrecorded == 0:
+            return None
+        values = self[quantity]
+        far = np.abs(values - values[-1]) > rtol*np.abs(values[-1])
+        if not far.any():
+            return int(self.iterations[0])
+        last_far = np.nonzero(far)[0][-1]
+        return int(self.iterations[min(last_far+1, self.nrecorded-1)])
+
+    def plot(self, quantities=None, fig=3):
+        """Plot the recorded quantities vs iteration, one subplot each."""
+        import matplotlib.pyplot as plt
+        quantities = quantities or self.quantities
+        plt.figure(fig)
+        plt.clf()
+        iterations = self.iterations[:self.nrecorded]
+        for ii, quantity in enumerate(quantities):
+            plt.subplot(len(quantities), 1, ii+1)
+            plt.plot(iterations, self[quantity])
+            plt.ylabel(quantity)
+        plt.xlabel('Iteration')
@@ -5,13 +5,8 @@ Created on Thu Mar 24 16:31:30 2016
 @author: Eric
 """
 import argparse
-import scipy.io as io
-#import pickle
 import LCALearner
-import numpy as np
-import sys
-import pca.pca
-sys.modules['pca'] = pca.pca #this is a workaround to get the pickled pca to load.  I think it basically tells python that pca.pca is an acceptable name for pca
+import spectrodata
 
 parser = argparse.ArgumentParser(description="Learn dictionaries for LCA with given parameters.")
 parser.add_argument('-o', '--overcompleteness', default=4, type=float)
@@ -29,16 +24,7 @@ numinput = 200
 numunits = int(oc*numinput)
 
 
-stuff = io.loadmat(datafolder+'PCAmatrices'+datasuffix+'.mat')
-mypca = pca.pca.PCA(dim=200,whiten=True)
-mypca.eVectors = stuff['E'].reshape((25,256,200))[:,::-1,:].reshape((6400,200)).T # flip the PC spectrograms upside down
-mypca.sValues = np.sqrt(np.diag(np.abs(stuff['D1'])))
-mypca.sValues = mypca.sValues[::-1]
-mypca.mean_vec = np.zeros(6400)
-mypca.ready=True
-origshape = (25,256)
-
-spectros = io.loadmat(datafolder+'dMatPCA'+datasuffix+'.mat')['dMatPCA'].T
+spectros, mypca, origshape = spectrodata.load_or_build(datafolder, datasuffix)
 
 lca = LCALearner.LCALearner(spectros, numunits, datatype="spectro", pca = mypca,  stimshape=origshape, paramfile='dummy')
 
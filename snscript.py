@@ -8,6 +8,7 @@ Created on Thu Jul 28 12:11:07 2016
 import argparse
 import pickle
 import sparsenet
+import DictLearner
 import numpy as np
 import scipy.io as io
 
@@ -18,6 +19,8 @@ parser.add_argument('-r', '--resultsfolder', default='',type=str)
 parser.add_argument('-s', '--datasuffix', default='ptwise', type=str)
 parser.add_argument('-i', '--niter', default=200, type=int)
 parser.add_argument('-l', '--lam', default=0.15, type=float)
+parser.add_argument('--solver', default='auto', type=str, choices=['auto', 'gd', 'cg', 'lbfgs', 'prox'])
+parser.add_argument('--init', default='random', type=str, choices=DictLearner.INIT_METHODS)
 args=parser.parse_args()
 
 data = args.data
@@ -35,7 +38,7 @@ if data == 'images':
     if resultsfolder == '':
         resultsfolder = '../vision/Results/'
     
-    net = sparsenet.Sparsenet(data, numunits, paramfile='dummy')
+    net = sparsenet.Sparsenet(data, numunits, paramfile='dummy', init=args.init)
 elif data == 'spectros':
     datafile = '../audition/Data/speech_ptwisecut'
     numinput = 200
@@ -48,10 +51,11 @@ elif data == 'spectros':
     if resultsfolder == '':
         resultsfolder = '../audition/Results/'
     
-    net = sparsenet.Sparsenet(data, numunits, datatype="spectro", pca = mypca, stimshape=origshape, paramfile='dummy')
+    net = sparsenet.Sparsenet(data, numunits, datatype="spectro", pca = mypca, stimshape=origshape, paramfile='dummy', init=args.init)
 
 net.niter = niter
 net.lamb = lam
+net.solver = args.solver
 net.learnrate = 0.0005
 net.gain_rate = 0.001
 
@@ -6,26 +6,51 @@ Created on Tue Jul 26 15:55:22 2016
 """
 
 import DictLearner
+import profiling
+import itertools
 import numpy as np
-import matplotlib.pyplot as plt
 
 class Sparsenet(DictLearner.DictLearner):
     """A sparse dictionary learner based on (Olshausen and Field, 1996)."""
     
     def __init__(self, data, nunits, learnrate=0.01, measure='abs', infrate=0.01,
                  niter=200, lamb=0.15, var_goal=0.1, gain_rate=0.02,
-                 var_eta=0.1, **kwargs):
+                 var_eta=0.1, solver='auto', tol=1e-4, **kwargs):
+        """
+        solver: how infer minimizes the energy for each batch:
+            'gd': niter steps of gradient descent of size infrate, as in the original
+            'cg' or 'lbfgs': nonlinear conjugate gradient or L-BFGS from scipy, for the
+                smooth measures ('log' and 'bell')
+            'prox': accelerated proximal gradient (FISTA), for measure 'abs'
+            'auto': 'prox' for 'abs', otherwise 'lbfgs'
+        tol: relative tolerance at which the iterative solvers stop; niter caps their iterations
+        """
         self.niter=niter
         self.lamb = lamb
-        self.infrate=0.01
+        self.infrate=infrate
+        self.solver = solver
+        self.tol = tol
         self.measure = measure
         self.var_goal = var_goal
         self.gains = np.ones(nunits)
         self.variances = self.var_goal*np.ones(nunits)
         self.var_eta = var_eta
         self.gain_rate = gain_rate
+        self._lipschitz_cache = (None, None)
         super().__init__(data, learnrate, nunits, **kwargs)
         
+    def S(self, acts):
+        """The activity-measuring function whose derivative is dSda."""
+        if self.measure == 'log':
+            return 0.5*np.log(1+acts*acts)
+        elif self.measure == 'abs':
+            return np.abs(acts)
+        elif self.measure == 'bell':
+            return -np.exp(-acts**2)
+            
+    def sparsity_cost(self, acts, thresh=None):
+        return self.lamb*np.mean(np.sum(self.S(acts), axis=0))
+    
     def dSda(self, acts):
         """Returns the derivative of the activity-measuring function, S in the Nature paper."""
         if self.measure == 'log':
@@ -37,31 +62,124 @@ class Sparsenet(DictLearner.DictLearner):
             return 2*acts*np.exp(-acts**2)
             
     
-    def infer(self, X, infplot=False):
-        acts = np.zeros((self.nunits,self.batch_size))
-        if infplot:
-            costY1 = np.zeros(self.niter)
-        phi_sq = self.Q.dot(self.Q.T)
+    def infer(self, X, infplot=False, trace=None):
+        """Minimize the energy (see DictLearner.energy) over the coefficients for
+        each column of X with self.solver. Returns (coefficients, None, None)."""
+        if infplot and trace is None:
+            trace = profiling.InferenceTrace(('error',))
+        if trace is not None:
+            trace.start(self.niter)
+        solver = self.solver
+        if solver == 'auto':
+            solver = 'prox' if self.measure == 'abs' else 'lbfgs'
+        phi_sq = self.gram()
         QX = self.Q.dot(X)
+        if solver == 'gd':
+            acts = self._infer_gd(X, phi_sq, QX, trace)
+        elif solver == 'prox':
+            if self.measure != 'abs':
+                raise ValueError("The proximal solver needs measure 'abs'.")
+            acts = self._infer_prox(X, phi_sq, QX, trace)
+        elif solver in ('cg', 'lbfgs'):
+            acts = self._infer_scipy(X, phi_sq, QX, solver, trace)
+        else:
+            raise ValueError("Unknown solver " + str(solver))
+        if trace is not None:
+            trace.finish(self.infer_iters)
+            if infplot:
+                trace.plot()
+        return acts, None, None
+        
+    def _infer_gd(self, X, phi_sq, QX, trace=None):
+        acts = np.zeros((self.Q.shape[0], X.shape[1]))
         for k in range(self.niter):    
             da_dt = QX - phi_sq.dot(acts) - self.lamb*self.dSda(acts)
             acts = acts+self.infrate*(da_dt)
             
-            if infplot:
-                costY1[k]=np.mean((X.T-np.dot(acts.T,self.Q))**2) 
-        if infplot:
-            plt.plot(costY1)
-        return acts, None, None
+            if trace is not None:
+                trace.record(k, self, X, acts)
+        self.infer_iters = self.niter
+        return acts
+        
+    def lipschitz(self):
+        """Largest eigenvalue of the gram matrix, the Lipschitz constant of the
+        gradient of the squared error, cached until Q changes."""
+        version, L = self._lipschitz_cache
+        if version != self.dict_version:
+            import scipy.sparse.linalg
+            L = scipy.sparse.linalg.eigsh(self.gram(), 1, which='LA')[0][0]
+            self._lipschitz_cache = (self.dict_version, L)
+        return L
+        
+    def _infer_prox(self, X, phi_sq, QX, trace=None):
+        """FISTA on the whole batch: gradient steps on the squared error of size
+        1/L, with L the largest eigenvalue of phi_sq, and soft thresholding."""
+        L = self.lipschitz()
+        acts = np.zeros((self.Q.shape[0], X.shape[1]))
+        y = acts
+        t = 1.
+        for k in range(self.niter):
+            z = y + (QX - phi_sq.dot(y))/L
+            new = np.sign(z)*np.maximum(np.abs(z) - self.lamb/L, 0.)
+            newt = (1 + np.sqrt(1 + 4*t*t))/2
+            y = new + ((t-1)/newt)*(new - acts)
+            change = np.linalg.norm(new - acts)
+            acts, t = new, newt
+            if trace is not None:
+                trace.record(k, self, X, acts)
+            if change <= self.tol*np.linalg.norm(acts):
+                break
+        self.infer_iters = k+1
+        return acts
+        
+    def _infer_scipy(self, X, phi_sq, QX, solver, trace=None):
+        """Minimize the summed energy of the batch with scipy. Since it is a sum
+        of independent terms, this solves every column at once."""
+        import scipy.optimize
+        shape = (self.Q.shape[0], X.shape[1])
+        constant = 0.5*np.sum(X*X)
+        
+        def fun(flat):
+            acts = flat.reshape(shape)
+            Gacts = phi_sq.dot(acts)
+            energy = constant - np.sum(acts*QX) + 0.5*np.sum(acts*Gacts) + self.lamb*np.sum(self.S(acts))
+            grad = Gacts - QX + self.lamb*self.dSda(acts)
+            return energy, grad.ravel()
+            
+        callback = None
+        if trace is not None:
+            count = itertools.count()
+            callback = lambda flat: trace.record(next(count), self, X, flat.reshape(shape))
+        method = 'CG' if solver == 'cg' else 'L-BFGS-B'
+        result = scipy.optimize.minimize(fun, np.zeros(np.prod(shape)), jac=True, method=method,
+                                         tol=self.tol, callback=callback, options={'maxiter': self.niter})
+        self.infer_iters = result.nit
+        return result.x.reshape(shape)
     
-    def learn(self, data, coeffs, normalize=True):
-        mse = super().learn(data, coeffs, normalize)
-        variances = np.diag(coeffs.dot(coeffs.T))/self.batch_size
+    def learn(self, data, coeffs, normalize=True, weights=None):
+        mse = super().learn(data, coeffs, normalize, weights)
+        if weights is None:
+            variances = np.mean(coeffs**2, axis=1)
+        else:
+            variances = (coeffs**2).dot(weights)/len(weights)
         self.variances = (1-self.var_eta)*self.variances + self.var_eta*variances
-        newgains = self.var_goal/self.variances
+        # elements whose coefficients vary too much grow, which shrinks their coefficients
+        newgains = self.variances/self.var_goal
         self.gains = self.gains*newgains**self.gain_rate
         self.Q = self.gains[:,np.newaxis]*self.Q
         return mse
         
+    def _reset_units(self, units):
+        others = np.setdiff1d(np.arange(len(self.gains)), units)
+        self.gains[units] = self.gains[others].mean() if len(others) else 1.
+        self.variances[units] = self.var_goal
+        super()._reset_units(units)
+        
+    def _grow_units(self, nnew):
+        self.gains = np.append(self.gains, np.full(nnew, self.gains.mean()))
+        self.variances = np.append(self.variances, np.full(nnew, self.var_goal))
+        super()._grow_units(nnew)
+        
     def sort(self, usages, sorter, plot=False, savestr=None):
         self.gains = self.gains[sorter]
         self.variances = self.variances[sorter]
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Builds and loads preprocessed spectrogram datasets.
+
+The PCA matrices (PCAmatrices*.mat) and the PC-vector data (dMatPCA*.mat) are
+converted once into a directory of .npy files plus a small json manifest.
+Loading the artifact memory-maps the arrays, so a learner can start without
+parsing .mat files or unpickling a pca object.
+
+Usage:
+    python spectrodata.py -f '../audition/Nicole Code/' -s new -o ../audition/Data/spectronew
+"""
+import argparse
+import json
+import os
+import numpy as np
+import StimSet
+
+FORMAT_VERSION = 1
+ARRAYS = ('data', 'eVectors', 'sValues', 'mean_vec')
+
+
+class ArrayPCA(object):
+    """Minimal PCA object holding the arrays needed to transform to and from
+    PC space. Attribute names follow pca.pca.PCA so this can stand in for it."""
+
+    def __init__(self, eVectors, sValues, mean_vec, dim=None, whiten=True):
+        self.eVectors = eVectors
+        self.sValues = sValues
+        self.mean_vec = mean_vec
+        self.dim = dim or eVectors.shape[0]
+        self.whiten = whiten
+        self.ready = True
+
+    def transform(self, data):
+        """Project data (samples along the first axis) onto the top dim PCs."""
+        pcs = (data - self.mean_vec).dot(self.eVectors[:self.dim].T)
+        if self.whiten:
+            pcs = pcs/self.sValues[:self.dim]
+        return pcs
+
+    def inverse_transform(self, pcs):
+        """Map PC vectors (samples along the first axis) back to the original space."""
+        if self.whiten:
+            pcs = pcs*self.sValues[:self.dim]
+        return pcs.dot(self.eVectors[:self.dim]) + self.mean_vec
+
+
+def _sources(datafolder, datasuffix):
+    return (os.path.join(datafolder, 'PCAmatrices'+datasuffix+'.mat'),
+            os.path.join(datafolder, 'dMatPCA'+datasuffix+'.mat'))
+
+
+def _source_info(paths):
+    info = {}
+    for path in paths:
+        stat = os.stat(path)
+        info[os.path.basename(path)] = [stat.st_size, int(stat.st_mtime)]
+    return info
+
+
+def build_dataset(datafolder, datasuffix, outdir, origshape=(25,256), dim=200, flip=True):
+    """Read PCAmatrices<datasuffix>.mat and dMatPCA<datasuffix>.mat from datafolder
+    and write the arrays and manifest to outdir. If flip, the PC spectrograms are
+    flipped upside down along the frequency axis, as in our sweep scripts."""
+    import scipy.io as io
+    pcafile, datafile = _sources(datafolder, datasuffix)
+    stuff = io.loadmat(pcafile)
+    stimsize = int(np.prod(origshape))
+    if flip:
+        eVectors = stuff['E'].reshape(origshape+(dim,))[:,::-1,:].reshape((stimsize,dim)).T
+    else:
+        eVectors = stuff['E'].T
+    arrays = {'data': io.loadmat(datafile)['dMatPCA'].T,
+              'eVectors': eVectors,
+              'sValues': np.sqrt(np.diag(np.abs(stuff['D1'])))[::-1],
+              'mean_vec': np.zeros(stimsize)}
+
+    os.makedirs(outdir, exist_ok=True)
+    for name in ARRAYS:
+        np.save(os.path.join(outdir, name+'.npy'), np.ascontiguousarray(arrays[name]))
+    manifest = {'format_version': FORMAT_VERSION,
+                'origshape': list(origshape),
+                'dim': dim,
+                'whiten': True,
+                'flip': flip,
+                'sources': _source_info((pcafile, datafile))}
+    with open(os.path.join(outdir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    return outdir
+
+
+def _read_manifest(path):
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    if manifest['format_version'] != FORMAT_VERSION:
+        raise ValueError("Dataset at " + path + " has format version " +
+                         str(manifest['format_version']) + ", expected " + str(FORMAT_VERSION))
+    return manifest
+
+
+def load_dataset(path, mmap=True):
+    """Returns (data, pca, origshape) from an artifact written by build_dataset.
+    Arrays are memory-mapped read-only unless mmap is False."""
+    manifest = _read_manifest(path)
+    mode = 'r' if mmap else None
+    arrays = {name: np.load(os.path.join(path, name+'.npy'), mmap_mode=mode) for name in ARRAYS}
+    pca = ArrayPCA(arrays['eVectors'], arrays['sValues'], arrays['mean_vec'],
+                   dim=manifest['dim'], whiten=manifest['whiten'])
+    return arrays['data'], pca, tuple(manifest['origshape'])
+
+
+def load_stimset(path, batch_size=None, mmap=True):
+    """Load an artifact straight into a PCvecSet."""
+    data, pca, origshape = load_dataset(path, mmap)
+    return StimSet.PCvecSet(data, origshape, pca, batch_size)
+
+
+def _build_settings(origshape=(25,256), dim=200, flip=True):
+    """The build_dataset options a manifest records, with build_dataset's defaults."""
+    return {'origshape': list(origshape), 'dim': dim, 'flip': flip}
+
+
+def load_or_build(datafolder, datasuffix, outdir=None, mmap=True, **kwargs):
+    """Load the artifact for the given .mat files, building it first if it is
+    missing, if the .mat files changed since it was built, or if it was built
+    with other options (kwargs of build_dataset). If the .mat files are not
+    available, an artifact built with other options raises ValueError."""
+    outdir = outdir or os.path.join(datafolder, 'spectro'+datasuffix)
+    settings = _build_settings(**kwargs)
+    try:
+        manifest = _read_manifest(outdir)
+    except (IOError, ValueError, KeyError):
+        stale = True
+    else:
+        mismatched = {key: manifest.get(key) for key in settings if manifest.get(key) != settings[key]}
+        try:
+            changed = manifest['sources'] != _source_info(_sources(datafolder, datasuffix))
+            stale = changed or bool(mismatched)
+        except OSError:
+            # the .mat files are not available here, so trust the artifact if it matches
+            if mismatched:
+                raise ValueError("Dataset at " + outdir + " was built with " + str(mismatched) +
+                                 ", not " + str({key: settings[key] for key in mismatched}) +
+                                 ", and the .mat files to rebuild it are not available.")
+            stale = False
+    if stale:
+        build_dataset(datafolder, datasuffix, outdir, **kwargs)
+    return load_dataset(outdir, mmap)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build a memory-mappable spectrogram dataset from PCA .mat files.")
+    parser.add_argument('-f', '--datafolder', default='../audition/Nicole Code/', type=str)
+    parser.add_argument('-s', '--datasuffix', default='new', type=str)
+    parser.add_argument('-o', '--outdir', default=None, type=str)
+    parser.add_argument('--noflip', action='store_true')
+    args = parser.parse_args()
+    outdir = args.outdir or os.path.join(args.datafolder, 'spectro'+args.datasuffix)
+    build_dataset(args.datafolder, args.datasuffix, outdir, flip=not args.noflip)
+    print("Wrote dataset to " + outdir)